@@ -1,9 +1,11 @@
+import hashlib
 import numpy as np
+from functools import reduce
 from scipy.linalg import expm
 from emlp.utils import Named, export
 import jax
 import jax.numpy as jnp
-from emlp.reps.linear_operators import LazyShift, SwapMatrix, Rot90, LazyKron, LazyKronsum, LazyPerm, I
+from emlp.reps.linear_operators import LazyShift, SwapMatrix, Rot90, LazyKron, LazyKronsum, LazyPerm, I, densify, lazify
 from jax import jit, vmap
 
 
@@ -82,6 +84,89 @@ class Group(object, metaclass=Named):
         jax_seed = np.random.randint(100)
         return noise2samples(z, k, A_dense, h_dense, jax_seed)
 
+    def elements(self, max_order=10000):
+        """ Enumerates the elements of a finite group by closing the discrete generators under
+            multiplication (breadth first). Output [gs (|G|,d,d)]"""
+        if len(self.lie_algebra): raise NotImplementedError(f"{self} is not a finite group")
+        if getattr(self, '_elements', None) is None:
+            self._elements = finite_closure(self.discrete_generators, self.d, max_order)
+        return self._elements
+
+    def haar_quadrature(self, resolution):
+        """ Quadrature rule (gs (M,d,d), weights (M,)) for integrating class functions (such as
+            characters) over the group with respect to the normalized Haar measure. For finite
+            groups these are all of the elements with uniform weights, compact Lie groups
+            integrate over a grid on the maximal torus with the given resolution per angle
+            which is exact for trigonometric polynomials of degree less than the resolution."""
+        gs = self.elements()
+        return gs, np.ones(len(gs)) / len(gs)
+
+    def minimal_generators(self):
+        """ A smaller set of generators (discrete_generators, lie_algebra) for the same group, which
+            yields fewer rows in the equivariance constraints. The Lie algebra is replaced by a few
+            elements that generate it under the Lie bracket (typically a pair of random combinations,
+            else a subset of the original elements), since the constraints dρ(A)v=0 and dρ(B)v=0
+            imply dρ([A,B])v=0. The discrete generators of finite groups are replaced by a few random
+            elements (or else a subset) generating a group of the same order, computed with
+            Schreier–Sims for permutation groups and by enumeration otherwise. Discrete
+            generators of groups with a continuous component, or of groups too large to
+            enumerate, are kept as is."""
+        if getattr(self, '_minimal_generators', None) is None:
+            rng = np.random.default_rng(0)
+            lie_algebra = self.lie_algebra
+            if len(self.lie_algebra) > 1:
+                lie_algebra = minimal_lie_generators(np.stack([densify(A) for A in self.lie_algebra]), rng)
+            discrete_generators = self.discrete_generators
+            if len(self.discrete_generators) > 1 and not len(self.lie_algebra):
+                discrete_generators = self._minimal_discrete_generators(rng)
+            self._minimal_generators = (discrete_generators, lie_algebra)
+        return self._minimal_generators
+
+    def subgroups(self):
+        """ The subgroups H of the group which appear in its class hierarchy (e.g. SO(n) < O(n),
+            C(k) < D(k) or SO13p < SO13 < O13) and whose generators are a subset of the generators
+            of G. Returns a list of pairs (H, (discrete_generators, lie_algebra)) with the
+            remaining generators of G, since the equivariant basis for G is the subspace of the
+            basis for H satisfying the constraints of the remaining generators."""
+        if getattr(self, '_subgroups', None) is None:
+            self._subgroups = []
+            for cls in type(self).__mro__[1:]:
+                if not issubclass(cls, Group) or cls is Group: continue
+                try:
+                    H = cls(*self.args)
+                except Exception:
+                    continue
+                if H.d != self.d: continue
+                remaining = [remaining_generators(self_gens, H_gens) for self_gens, H_gens in
+                             [(self.discrete_generators, H.discrete_generators), (self.lie_algebra, H.lie_algebra)]]
+                if None not in remaining:
+                    self._subgroups.append((H, tuple(remaining)))
+        return self._subgroups
+
+    def _minimal_discrete_generators(self, rng, trials=10):
+        gens = list(self.discrete_generators)
+        if self.is_permutation:
+            order = lambda hs: stabilizer_order(schreier_sims([permutation_indices(h) for h in hs], self.d))
+            transversals = schreier_sims([permutation_indices(h) for h in gens], self.d)
+            random_element = lambda: LazyPerm(random_permutation(transversals, rng))
+        else:
+            order = lambda hs: len(finite_closure(hs, self.d))
+            try:
+                elements = self.elements()
+            except NotImplementedError:  # too large (or not finite) to enumerate, keep the generators as given
+                return self.discrete_generators
+            random_element = lambda: elements[rng.integers(len(elements))]
+        full_order = order(gens)
+        # Look for a smaller set of random elements generating the group, else drop redundant generators
+        for m in range(1, len(gens)):
+            for _ in range(trials):
+                candidates = [random_element() for _ in range(m)]
+                if order(candidates) == full_order: return candidates
+        for h in reversed(list(gens)):
+            others = [g for g in gens if g is not h]
+            if order(others) == full_order: gens = others
+        return gens
+
     def check_valid_group_elems(self, g):
         return True
 
@@ -102,12 +187,170 @@ class Group(object, metaclass=Named):
 
     def __lt__(self, other):
         """ For sorting purposes only """
-        return hash(self) < hash(other)
+        return repr(self) < repr(other)
+
+    def fingerprint(self):
+        """ Deterministic (across processes) SHA-256 fingerprint of the group, computed
+            from its name and the values of its generators."""
+        if getattr(self, '_fingerprint', None) is None:
+            h = hashlib.sha256(repr(self).encode())
+            for gens in (self.discrete_generators, self.lie_algebra):
+                for gen in gens:
+                    M = np.asarray(densify(gen))
+                    M = np.ascontiguousarray(M, dtype=np.complex128 if np.iscomplexobj(M) else np.float64)
+                    h.update(str(M.shape).encode())
+                    h.update(M.tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
 
     def __mul__(self, other):
         return DirectProduct(self, other)
 
 
+def remaining_generators(generators, subset):
+    """ The elements of generators not matching any element of subset, or None if some element of
+        subset is not among the generators."""
+    dense = [np.asarray(densify(g)) for g in generators]
+    matched = set()
+    for h in subset:
+        h = np.asarray(densify(h))
+        matches = [i for i, g in enumerate(dense) if i not in matched and np.allclose(g, h)]
+        if not matches: return None
+        matched.add(matches[0])
+    return [g for i, g in enumerate(generators) if i not in matched]
+
+
+def finite_closure(generators, d, max_order=10000):
+    """ Enumerates the elements of the finite group generated by the (d,d) matrices generators
+        by closing them under multiplication (breadth first). Output (|G|,d,d)"""
+    key = lambda g: (np.round(g, 6) + 0.).tobytes()
+    gens = [np.asarray(densify(h), dtype=np.float64) for h in generators]
+    identity = np.eye(d)
+    elements = {key(identity): identity}
+    frontier = [identity]
+    while frontier:
+        new = []
+        for g in frontier:
+            for h in gens:
+                gh = g @ h
+                if key(gh) not in elements:
+                    elements[key(gh)] = gh
+                    new.append(gh)
+        if len(elements) > max_order: raise NotImplementedError(f"Group has more than {max_order} elements")
+        frontier = new
+    return np.stack(list(elements.values()))
+
+
+def permutation_indices(h):
+    """ The integer permutation perm of a (lazy) permutation matrix h such that h@v = v[perm]"""
+    n = h.shape[-1]
+    return np.rint(np.asarray(lazify(h) @ np.arange(n, dtype=np.float64))).astype(int)
+
+
+def schreier_sims(perms, n):
+    """ Stabilizer chain of the group generated by the integer permutations perms of n points,
+        computed with the (deterministic) Schreier–Sims algorithm. Returns the transversals: for
+        each base point b a dictionary mapping the points j in the orbit of b under the pointwise
+        stabilizer of the previous base points to an element taking b to j. """
+    identity = np.arange(n)
+    strong = [np.asarray(p) for p in perms if (np.asarray(p) != identity).any()]
+    base = []
+    for p in strong:
+        if all(p[b] == b for b in base): base.append(int(np.flatnonzero(p != identity)[0]))
+
+    def transversal(i):
+        gens = [s for s in strong if all(s[b] == b for b in base[:i])]
+        orbit = {base[i]: identity}
+        queue = [base[i]]
+        while queue:
+            x = queue.pop()
+            for s in gens:
+                if s[x] not in orbit:
+                    orbit[s[x]] = s[orbit[x]]
+                    queue.append(s[x])
+        return orbit
+
+    def sift(g, i):
+        for j in range(i, len(base)):
+            x = g[base[j]]
+            if x not in inverses[j]: return g, j
+            g = inverses[j][x][g]
+        return g, len(base)
+
+    transversals = [transversal(i) for i in range(len(base))]
+    inverses = [{x: np.argsort(u) for x, u in t.items()} for t in transversals]
+    i = len(base) - 1
+    while i >= 0:
+        gens = [s for s in strong if all(s[b] == b for b in base[:i])]
+        schreier_gens = (inverses[i][s[x]][s[u]] for x, u in list(transversals[i].items()) for s in gens)
+        for h in schreier_gens:
+            h, j = sift(h, i + 1)
+            if (h != identity).any():  # h is not yet covered by the chain, add it as a strong generator
+                strong.append(h)
+                if j == len(base):
+                    base.append(int(np.flatnonzero(h != identity)[0]))
+                    transversals.append(None)
+                    inverses.append(None)
+                for l in range(i + 1, j + 1):
+                    transversals[l] = transversal(l)
+                    inverses[l] = {x: np.argsort(u) for x, u in transversals[l].items()}
+                i = j
+                break
+        else:
+            i -= 1
+    return transversals
+
+
+def stabilizer_order(transversals):
+    """ Order of a permutation group from the transversals of its stabilizer chain"""
+    return reduce(lambda a, b: a * b, [len(t) for t in transversals], 1)
+
+
+def random_permutation(transversals, rng):
+    """ Uniformly random element of a permutation group given the transversals of its stabilizer chain"""
+    g = None
+    for t in transversals:
+        u = list(t.values())[rng.integers(len(t))]
+        g = u if g is None else g[u]
+    return g
+
+
+def lie_closure_rank(generators):
+    """ Dimension of the Lie algebra generated by the (k,d,d) matrices generators under the
+        bracket [A,B]=AB-BA, from the span of their iterated brackets."""
+    generators = np.asarray(generators, dtype=np.result_type(generators.dtype, np.float64))
+    d = generators.shape[-1]
+    scale = max(1., np.abs(generators).max())
+    basis = np.zeros((0, d * d), dtype=generators.dtype)
+    new = list(generators)
+    while new and len(basis) < d * d:
+        candidates = np.stack(new).reshape(len(new), -1)
+        residual = candidates - (candidates @ basis.conj().T) @ basis
+        U, S, VH = np.linalg.svd(residual, full_matrices=False)
+        VH = VH[S > 1e-8 * scale]
+        if not len(VH): break
+        basis = np.concatenate([basis, VH])
+        new = [A @ B.reshape(d, d) - B.reshape(d, d) @ A for A in generators for B in VH]
+    return len(basis)
+
+
+def minimal_lie_generators(lie_algebra, rng, trials=10):
+    """ A small set of elements generating the same Lie algebra as lie_algebra (k,d,d) under the bracket:
+        either a few random linear combinations of them or, failing that, a subset of the elements."""
+    lie_algebra = np.asarray(lie_algebra)
+    full_rank = lie_closure_rank(lie_algebra)
+    for m in range(1, len(lie_algebra)):
+        for _ in range(trials):
+            combinations = rng.standard_normal((m, len(lie_algebra))) @ lie_algebra.reshape(len(lie_algebra), -1)
+            combinations = combinations.reshape(m, *lie_algebra.shape[1:]).astype(lie_algebra.dtype)
+            if lie_closure_rank(combinations) == full_rank: return jax.device_put(combinations)
+    keep = list(range(len(lie_algebra)))
+    for i in reversed(range(len(lie_algebra))):
+        others = [j for j in keep if j != i]
+        if others and lie_closure_rank(lie_algebra[others]) == full_rank: keep = others
+    return jax.device_put(lie_algebra[keep])
+
+
 @jit
 def matrix_power_simple(M, n):
     out = jnp.eye(M.shape[-1])
@@ -150,6 +393,34 @@ class Trivial(Group):
         super().__init__(n)
 
 
+def torus_grid(num_angles, resolution):
+    """ Uniform grid with resolution points per angle on the torus [0,2π)^num_angles. Output (M,num_angles)"""
+    theta = 2 * np.pi * np.arange(resolution) / resolution
+    if num_angles == 0: return np.zeros((1, 0))
+    return np.stack(np.meshgrid(*num_angles * [theta], indexing='ij'), -1).reshape(-1, num_angles)
+
+
+def rotation_blocks(thetas, fixed=()):
+    """ Block diagonal orthogonal matrices with 2x2 rotations by the angles thetas (M,k)
+        followed by the diagonal entries fixed. Output (M,2k+len(fixed),2k+len(fixed))"""
+    M, k = thetas.shape
+    gs = np.zeros((M, 2 * k + len(fixed), 2 * k + len(fixed)))
+    for j in range(k):
+        gs[:, 2 * j, 2 * j] = gs[:, 2 * j + 1, 2 * j + 1] = np.cos(thetas[:, j])
+        gs[:, 2 * j, 2 * j + 1] = -np.sin(thetas[:, j])
+        gs[:, 2 * j + 1, 2 * j] = np.sin(thetas[:, j])
+    for i, eig in enumerate(fixed):
+        gs[:, 2 * k + i, 2 * k + i] = eig
+    return gs
+
+
+def cos_vandermonde(thetas):
+    """ Π_{i<j}(cos θᵢ - cos θⱼ)², the Weyl density shared by the orthogonal groups"""
+    c = np.cos(thetas)
+    i, j = np.triu_indices(thetas.shape[-1], 1)
+    return np.prod((c[:, i] - c[:, j]) ** 2, -1)
+
+
 @export
 class SO(Group):
     """ The special orthogonal group SO(n) in n dimensions"""
@@ -164,6 +435,12 @@ class SO(Group):
                 k += 1
         super().__init__(n)
 
+    def haar_quadrature(self, resolution):
+        thetas = torus_grid(self.d // 2, resolution)
+        density = cos_vandermonde(thetas)
+        if self.d % 2: density *= np.prod(np.sin(thetas / 2) ** 2, -1)
+        return rotation_blocks(thetas, (self.d % 2) * [1]), density / density.sum()
+
 
 @export
 class O(SO):
@@ -174,6 +451,16 @@ class O(SO):
         self.discrete_generators[0, 0, 0] = -1
         super().__init__(n)
 
+    def haar_quadrature(self, resolution):
+        gs, ws = super().haar_quadrature(resolution)
+        # The coset of reflections, with eigenvalue -1 (and +1 when n is even)
+        thetas = torus_grid((self.d - 1) // 2, resolution)
+        density = cos_vandermonde(thetas)
+        if self.d % 2: density *= np.prod(np.cos(thetas / 2) ** 2, -1)
+        else: density *= np.prod(np.sin(thetas) ** 2, -1)
+        reflections = rotation_blocks(thetas, [-1] if self.d % 2 else [1, -1])
+        return np.concatenate([gs, reflections]), np.concatenate([ws, density / density.sum()]) / 2
+
 
 @export
 class C(Group):
@@ -368,6 +655,19 @@ class U(Group):  # Of dimension n^2
         self.lie_algebra = lie_algebra_real + lie_algebra_imag * 1j
         super().__init__(n)
 
+    def haar_quadrature(self, resolution):
+        return unitary_torus(torus_grid(self.d, resolution))
+
+
+def unitary_torus(thetas):
+    """ Diagonal unitaries with eigenphases thetas (M,n) and their normalized Weyl
+        density Π_{i<j}|exp(iθᵢ)-exp(iθⱼ)|²"""
+    z = np.exp(1j * thetas)
+    i, j = np.triu_indices(thetas.shape[-1], 1)
+    density = np.prod(np.abs(z[:, i] - z[:, j]) ** 2, -1)
+    gs = z[:, :, None] * np.eye(thetas.shape[-1])
+    return gs, density / density.sum()
+
 
 @export
 class SU(Group):  # Of dimension n^2-1
@@ -398,6 +698,10 @@ class SU(Group):  # Of dimension n^2-1
         self.lie_algebra = lie_algebra_real + lie_algebra_imag * 1j
         super().__init__(n)
 
+    def haar_quadrature(self, resolution):
+        thetas = torus_grid(self.d - 1, resolution)
+        return unitary_torus(np.concatenate([thetas, -thetas.sum(-1, keepdims=True)], -1))
+
 
 @export
 class Cube(Group):
@@ -492,6 +796,8 @@ class Embed(Group):
         self.discrete_generators += np.eye(d)
         self.lie_algebra[:, slice, slice] = G.lie_algebra
         self.discrete_generators[:, slice, slice] = G.discrete_generators
+        self.embedded = G  # acting on the coordinates embedded_indices, and trivially on the rest
+        self.embedded_indices = np.arange(d)[slice]
         self.name = f"{G}_R{d}"
         super().__init__()
 
@@ -525,6 +831,7 @@ class DirectProduct(Group):
         self.discrete_generators = [LazyKron([M1, I2]) for M1 in G1.discrete_generators] + [LazyKron([I1, M2]) for M2 in
                                                                                             G2.discrete_generators]
         self.names = (repr(G1), repr(G2))
+        self.factors = (G1, G2)  # The base representation is the Kronecker product V₁⊗V₂
         super().__init__()
 
     def __repr__(self):
@@ -2,7 +2,7 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 from emlp.reps import T, Rep, Scalar
-from emlp.reps import bilinear_weights
+from emlp.reps import bilinear_weights, SolvePlan
 # from emlp.reps import LinearOperator # why does this not work?
 from emlp.reps.linear_operator_base import LinearOperator
 from emlp.reps.product_sum_reps import SumRep
@@ -45,6 +45,33 @@ class _Linear(nn.Module):
         return x @ W.T + B
 
 
+@export
+def BasisLinear(repin, repout):
+    """ Equivariant Linear layer from repin to repout with the weights and bias parametrized
+        by their coefficients in the equivariant bases, W = Qθ."""
+    cout = repout.size()
+    rep_W = repin >> repout
+    Qw = rep_W.equivariant_basis()
+    Qb = repout.equivariant_basis()
+    logging.info(f"BasisLinear W coefficients:{Qw.shape[-1]} rep:{rep_W}")
+    return _BasisLinear(Qw, Qb, cout)
+
+
+class _BasisLinear(nn.Module):
+    Qw: LinearOperator
+    Qb: LinearOperator
+    cout: int
+
+    @nn.compact
+    def __call__(self, x):
+        scale = 1 / np.sqrt(x.shape[-1])
+        w = self.param('w', lambda key, shape: scale * jax.random.normal(key, shape), (self.Qw.shape[-1],))
+        b = self.param('b', nn.initializers.zeros, (self.Qb.shape[-1],))
+        W = (self.Qw @ w).reshape(self.cout, x.shape[-1])
+        B = self.Qb @ b
+        return x @ W.T + B
+
+
 @export
 def BiLinear(repin, repout):
     """ Cheap bilinear layer (adds parameters for each part of the input which can be
@@ -129,6 +156,8 @@ def EMLP(rep_in, rep_out, group, ch=384, num_layers=3):
         middle_layers = [(c(group) if isinstance(c, Rep) else uniform_rep(c, group)) for c in ch]
     reps = [rep_in] + middle_layers
     logging.info(f"Reps: {reps}")
+    # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+    SolvePlan([(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], rep_out)]).execute()
     return Sequential(*[EMLPBlock(rin, rout) for rin, rout in zip(reps, reps[1:])], Linear(reps[-1], rep_out))
 
 
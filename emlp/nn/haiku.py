@@ -2,7 +2,7 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 from emlp.reps import Rep
-from emlp.reps import bilinear_weights
+from emlp.reps import bilinear_weights, SolvePlan
 from emlp.utils import export
 import logging
 import haiku as hk
@@ -43,6 +43,36 @@ class hkLinear(hk.Module):
         return x @ W.T + b
 
 
+@export
+def BasisLinear(repin, repout):
+    """ Equivariant Linear layer from repin to repout with the weights and bias parametrized
+        by their coefficients in the equivariant bases, W = Qθ."""
+    rep_W = repout << repin
+    Qw = rep_W.equivariant_basis()
+    Qb = repout.equivariant_basis()
+    logging.info(f"BasisLinear W coefficients:{Qw.shape[-1]} rep:{rep_W}")
+    return lambda x: hkBasisLinear(Qw, Qb, (repout.size(), repin.size()))(x)
+
+
+class hkBasisLinear(hk.Module):
+    """ Equivariant Linear layer with the weights stored as coefficients in the equivariant basis."""
+
+    def __init__(self, Qw, Qb, shape, name=None):
+        super().__init__(name=name)
+        self.Qw = Qw
+        self.Qb = Qb
+        self.shape = shape
+
+    def __call__(self, x):  # (cin) -> (cout)
+        i, j = self.shape
+        w_init = hk.initializers.TruncatedNormal(1. / np.sqrt(i))
+        w = hk.get_parameter("w", shape=[self.Qw.shape[-1]], dtype=x.dtype, init=w_init)
+        b = hk.get_parameter("b", shape=[self.Qb.shape[-1]], dtype=x.dtype, init=w_init)
+        W = (self.Qw @ w).reshape(*self.shape)
+        b = self.Qb @ b
+        return x @ W.T + b
+
+
 @export
 def BiLinear(repin, repout):
     """ Cheap bilinear layer (adds parameters for each part of the input which can be
@@ -127,6 +157,8 @@ def EMLP(rep_in, rep_out, group, ch=384, num_layers=3):
     # assert all((not rep.G is None) for rep in middle_layers[0].reps)
     reps = [rep_in] + middle_layers
     # logging.info(f"Reps: {reps}")
+    # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+    SolvePlan([(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], rep_out)]).execute()
     network = Sequential(
         *[EMLPBlock(rin, rout) for rin, rout in zip(reps, reps[1:])],
         Linear(reps[-1], rep_out)
@@ -4,7 +4,7 @@ import objax.nn as nn
 import objax.functional as F
 import numpy as np
 from emlp.reps import T, Rep, Scalar
-from emlp.reps import bilinear_weights
+from emlp.reps import bilinear_weights, SolvePlan, TensorContractions, RegularConvolutions
 from emlp.reps.product_sum_reps import SumRep
 import collections
 from emlp.utils import Named, export
@@ -19,7 +19,7 @@ import objax
 from objax.nn.init import orthogonal
 from scipy.special import binom
 from jax import jit, vmap
-from functools import lru_cache as cache
+from functools import lru_cache as cache, partial
 
 
 def Sequential(*args):
@@ -29,7 +29,10 @@ def Sequential(*args):
 
 @export
 class Linear(nn.Linear):
-    """ Basic equivariant Linear layer from repin to repout."""
+    """ Basic equivariant Linear layer from repin to repout.
+        When wrapped by a ProjectedOptimizer (projected=True) the weights are kept equivariant
+        by the optimizer and are used directly, without projecting them in the forward pass."""
+    projected = False
 
     def __init__(self, repin, repout):
         nin, nout = repin.size(), repout.size()
@@ -45,6 +48,8 @@ class Linear(nn.Linear):
 
     def __call__(self, x):  # (cin) -> (cout)
         logging.debug(f"linear in shape: {x.shape}")
+        if self.projected:
+            return x @ self.w.value.T + self.b.value
         W = (self.Pw @ self.w.value.reshape(-1)).reshape(*self.w.value.shape)
         b = self.Pb @ self.b.value
         out = x @ W.T + b
@@ -52,6 +57,153 @@ class Linear(nn.Linear):
         return out
 
 
+@export
+class BasisLinear(Module):
+    """ Equivariant Linear layer from repin to repout parametrized by the coefficients θ of the
+        weights in the equivariant basis Q (N,r) of repout*repin.T, W = Qθ (and likewise for the bias),
+        so the trainable variables, optimizer state and the cost of forming W scale with r instead
+        of nout*nin. The coefficients are initialized to give W the same scale as in Linear."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        nin, nout = repin.size(), repout.size()
+        rep_W = repout * repin.T
+        self.Qw = rep_W.equivariant_basis()
+        self.Qb = repout.equivariant_basis()
+        self.shape = (nout, nin)
+        self.w = TrainVar(objax.random.normal((self.Qw.shape[-1],)) / jnp.sqrt(max(nout, nin)))
+        self.b = TrainVar(objax.random.uniform((self.Qb.shape[-1],)) / jnp.sqrt(nout))
+        logging.info(f"BasisLinear W coefficients:{self.Qw.shape[-1]} rep:{rep_W}")
+
+    def __call__(self, x):  # (cin) -> (cout)
+        W = (self.Qw @ self.w.value).reshape(*self.shape)
+        b = self.Qb @ self.b.value
+        return x @ W.T + b
+
+
+@export
+class ContractionLinear(Module):
+    """ Equivariant Linear layer from repin to repout for O(n), SO(n) and the Lorentz groups,
+        parametrized by the coefficients of the δ/η/ε contraction patterns (see TensorContractions)
+        instead of by a projected dense weight matrix, so no basis is solved for."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.contractions = TensorContractions(repin, repout)
+        self.constants = [jnp.asarray(c) for c in self.contractions.backend_constants()]
+        nin = max(repin.size(), 1)
+        self.w = TrainVar(objax.random.normal((self.contractions.weight_size,)) / jnp.sqrt(nin))
+        self.b = TrainVar(objax.random.normal((self.contractions.bias_size,)) / jnp.sqrt(repout.size()))
+        logging.info(f"ContractionLinear coefficients:{self.contractions.weight_size} {repin} -> {repout}")
+
+    def __call__(self, x):  # (cin) -> (cout)
+        return self.contractions(x, self.w.value, self.b.value, self.constants, jnp.einsum,
+                                 lambda ys: jnp.concatenate(ys, -1), jnp.zeros)
+
+
+@export
+class ConvolutionLinear(Module):
+    """ Equivariant Linear layer from repin to repout (sums of V and scalars) for ℤₙ and ℤₖ⋉(ℤₙ×ℤₙ),
+        where the maps between the regular representations V are group convolutions with a kernel
+        of |G| parameters per pair of channels, applied with the FFT (see RegularConvolutions)."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.convolutions = RegularConvolutions(repin, repout)
+        self.constants = [jnp.asarray(c) for c in self.convolutions.backend_constants()]
+        self.axes = tuple(range(-len(self.convolutions.grid), 0))
+        self.w = TrainVar(objax.random.normal((self.convolutions.weight_size,)) / jnp.sqrt(max(repin.size(), 1)))
+        self.b = TrainVar(objax.random.normal((self.convolutions.bias_size,)) / jnp.sqrt(repout.size()))
+        logging.info(f"ConvolutionLinear coefficients:{self.convolutions.weight_size} {repin} -> {repout}")
+
+    def __call__(self, x):  # (cin) -> (cout)
+        return self.convolutions(x, self.w.value, self.b.value, self.constants, jnp.einsum,
+                                 partial(jnp.fft.fftn, axes=self.axes), partial(jnp.fft.ifftn, axes=self.axes),
+                                 lambda ys: jnp.concatenate(ys, -1), jnp.zeros)
+
+
+@export
+class OrbitLinear(Module):
+    """ Equivariant Linear layer from repin to repout for permutation representations of discrete
+        groups. The equivariant weights are constant on the orbits of the group acting on the entries
+        of W (and of the bias), so the layer stores one parameter per orbit and the int32 orbit label
+        of each entry, and forms W with a single gather instead of projecting a dense weight."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        nin, nout = repin.size(), repout.size()
+        num_w, self.w_orbits = (repout * repin.T).orbits()
+        num_b, self.b_orbits = repout.orbits()
+        self.w = TrainVar(objax.random.normal((num_w,)) / jnp.sqrt(nin))
+        self.b = TrainVar(objax.random.normal((num_b,)) / jnp.sqrt(nout))
+        self.shape = (nout, nin)
+        logging.info(f"OrbitLinear orbits:{num_w} {repin} -> {repout}")
+
+    def __call__(self, x):  # (cin) -> (cout)
+        W = self.w.value[self.w_orbits].reshape(*self.shape)
+        return x @ W.T + self.b.value[self.b_orbits]
+
+
+def submodules(module):
+    """ The objax modules contained in module (including module itself)."""
+    seen, stack = set(), [module]
+    while stack:
+        module = stack.pop()
+        if id(module) in seen: continue
+        seen.add(id(module))
+        yield module
+        children = list(module) if isinstance(module, objax.ModuleList) else list(vars(module).values())
+        stack.extend(child for child in children if isinstance(child, Module))
+
+
+@export
+class ProjectedOptimizer(Module):
+    """ Wraps an objax optimizer (e.g. objax.optimizer.Adam(model.vars())) to keep the weights of the
+        equivariant Linear layers of model in the equivariant subspace by projecting them with Pw and Pb
+        once after every update, rather than projecting them in every forward pass. The layers are
+        switched to use their weights directly, so evaluation pays no projection cost at all.
+        Every check_every steps the relative distance of the weights from their projection is
+        checked before the update, and if it exceeds tol (e.g. after the weights were modified
+        outside of the optimizer) a warning is logged, the weights being projected again afterwards.
+        The step count is a StateVar and the check runs under lax.cond, so the update can be wrapped
+        in objax.Jit together with the optimizer vars().
+        Use with the Trainer as optim=lambda params: ProjectedOptimizer(model, objax.optimizer.Adam(params))."""
+
+    def __init__(self, model, optimizer, check_every=100, tol=1e-4):
+        self.optimizer = optimizer
+        self.check_every = check_every
+        self.tol = tol
+        self.steps = StateVar(jnp.array(0, jnp.int32))
+        self.layers = [m for m in submodules(model) if isinstance(m, Linear)]
+        for layer in self.layers:
+            layer.projected = True
+        self.project()
+
+    def project(self):
+        """ Projects the weights and biases of the layers onto the equivariant subspace."""
+        for layer in self.layers:
+            w, b = objax.TrainRef(layer.w), objax.TrainRef(layer.b)
+            w.value = (layer.Pw @ w.value.reshape(-1)).reshape(*w.value.shape)
+            b.value = layer.Pb @ b.value
+
+    def drift(self):
+        """ The largest relative distance ‖Pw-w‖/‖w‖ of the weights (and biases) from the equivariant subspace."""
+        rel_dist = lambda P, w: jnp.linalg.norm(P @ w.reshape(-1) - w.reshape(-1)) / (jnp.linalg.norm(w) + 1e-12)
+        return jnp.max(jnp.array([0.] + [rel_dist(P, v.value) for layer in self.layers
+                                         for P, v in ((layer.Pw, layer.w), (layer.Pb, layer.b))]))
+
+    def warn(self, drift):
+        if drift > self.tol: logging.warning(f"Equivariant weights drifted by {float(drift):.2e} from their projection")
+
+    def __call__(self, lr, grads, *args, **kwargs):
+        if self.check_every:
+            check = self.steps.value % self.check_every == 0
+            jax.debug.callback(self.warn, jax.lax.cond(check, self.drift, lambda: jnp.zeros(())))
+        self.optimizer(lr, grads, *args, **kwargs)
+        self.project()
+        self.steps.value += 1
+
+
 @export
 class BiLinear(Module):
     """ Cheap bilinear layer (adds parameters for each part of the input which can be
@@ -215,6 +367,8 @@ class EMLP(Module, metaclass=Named):
         # assert all((not rep.G is None) for rep in middle_layers[0].reps)
         reps = [self.rep_in] + middle_layers
         logging.info(f"Reps: {reps}")
+        # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+        SolvePlan([(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], self.rep_out)]).execute()
         self.network = Sequential(
             *[EMLPBlock(rin, rout) for rin, rout in zip(reps, reps[1:])],
             Linear(reps[-1], self.rep_out)
@@ -324,6 +478,8 @@ class EMLPode(EMLP):
         # print(self.rep_in.G)
         reps = [self.rep_in] + middle_layers
         logging.info(f"Reps: {reps}")
+        # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+        SolvePlan([(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], self.rep_out)]).execute()
         self.network = Sequential(
             *[EMLPBlock(rin, rout) for rin, rout in zip(reps, reps[1:])],
             Linear(reps[-1], self.rep_out)
@@ -10,7 +10,7 @@ import numpy as np
 import types
 from functools import partial
 from emlp.reps import T, Rep, Scalar
-from emlp.reps import bilinear_weights, torch_bilinear_weights
+from emlp.reps import bilinear_weights, torch_bilinear_weights, SolvePlan, TensorContractions, RegularConvolutions
 from emlp.utils import Named, export
 from dbgpy import dbg
 import logging
@@ -79,9 +79,17 @@ def torchify_fn(function):
 def ensure_sum_rep(rep):
     return rep if isinstance(rep, SumRep) else SumRep(rep)
 
-@export
-class EquivLinear(nn.Linear):
-    """ Basic equivariant Linear layer from repin to repout."""
+class ProjectedLinear(nn.Linear):
+    """ Shared machinery of the Linear layers whose weights are projected with Pw and Pb.
+        When wrapped by a ProjectedOptimizer (projected=True) or frozen, the weights are already
+        equivariant and are used directly, without projecting them in the forward pass.
+        Otherwise the projections are cached whenever no gradients of the parameters are needed
+        (e.g. evaluation under torch.no_grad), and recomputed only once the parameters change,
+        as tracked by their _version counters (bumped by optimizer steps, load_state_dict and any
+        other in place update) and their storage."""
+    projected = False
+    frozen = False
+    _projection_cache = None
 
     def proj_b(self, b):
         return self.Pb @ b
@@ -89,6 +97,48 @@ class EquivLinear(nn.Linear):
     def proj_w(self, w):
         return (self.Pw @ w.reshape(-1)).reshape(self.nout, self.nin)
 
+    def projected_parameters(self):
+        """ The equivariant (weight,bias) used in the forward pass."""
+        if self.projected or self.frozen:
+            return self.weight, self.bias
+        if torch.is_grad_enabled() and (self.weight.requires_grad or self.bias.requires_grad):
+            with torch.profiler.record_function('Weight projection'):
+                weight = self.proj_w(self.weight)
+            with torch.profiler.record_function('Bias projection'):
+                bias = self.proj_b(self.bias)
+            return weight, bias
+        key = (self.weight._version, self.bias._version, self.weight.data_ptr(), self.bias.data_ptr())
+        if self._projection_cache is None or self._projection_cache[0] != key:
+            with torch.no_grad():
+                self._projection_cache = (key, self.proj_w(self.weight), self.proj_b(self.bias))
+        return self._projection_cache[1:]
+
+    @torch.no_grad()
+    def freeze(self):
+        """ Projects the weights in place and turns the layer into a plain nn.Linear with fixed
+            (non trainable) equivariant weights, for inference."""
+        if not self.frozen and not self.projected:
+            self.weight.copy_(self.proj_w(self.weight))
+            self.bias.copy_(self.proj_b(self.bias))
+        self.weight.requires_grad_(False)
+        self.bias.requires_grad_(False)
+        self.frozen = True
+        self._projection_cache = None
+        return self
+
+    def unfreeze(self):
+        """ Makes the weights trainable again. As the frozen weights are already projected,
+            the layer computes the same function as before freezing."""
+        self.weight.requires_grad_(True)
+        self.bias.requires_grad_(True)
+        self.frozen = False
+        return self
+
+
+@export
+class EquivLinear(ProjectedLinear):
+    """ Basic equivariant Linear layer from repin to repout."""
+
     def __init__(self, repin, repout):
         self.nin, self.nout = repin.size(), repout.size()
         super().__init__(self.nin, self.nout)
@@ -120,22 +170,104 @@ class EquivLinear(nn.Linear):
         # TODO: Port the projection to PyTorch
         # weight = (self.dense_Pw @ self.weight.reshape(-1)).reshape(self.out_features, self.in_features)
         # bias = self.dense_Pb @ self.bias
-        with torch.profiler.record_function('Weight projection'):
-            weight = self.proj_w(self.weight)
-        with torch.profiler.record_function('Bias projection'):
-            bias = self.proj_b(self.bias)
+        weight, bias = self.projected_parameters()
         return F.linear(x, weight, bias)
 
 
 @export
-class SeparatedEquivLinear(nn.Linear):
-    """ Basic equivariant Linear layer from repin to repout."""
+class BasisEquivLinear(nn.Module):
+    """ Equivariant Linear layer from repin to repout parametrized by the coefficients θ of the
+        weights in the equivariant basis Q (N,r) of repout*repin.T, W = Qθ (and likewise for the bias),
+        so the trainable parameters, optimizer state and the cost of forming W scale with r instead
+        of nout*nin. The coefficients are initialized to give W the same scale as in EquivLinear."""
 
-    def proj_b(self, b):
-        return self.Pb @ b
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.nin, self.nout = repin.size(), repout.size()
+        rep_W = ensure_sum_rep(repout * repin.T)
+        self.Qw = rep_W.torch_equivariant_basis()
+        self.Qb = ensure_sum_rep(repout).torch_equivariant_basis()
+        bound = 1 / np.sqrt(self.nin)
+        self.weight = nn.Parameter(torch.empty(self.Qw.shape[-1]).uniform_(-bound, bound) / np.sqrt(3))
+        self.bias = nn.Parameter(torch.empty(self.Qb.shape[-1]).uniform_(-bound, bound))
+        logging.info(f"BasisEquivLinear W coefficients:{self.Qw.shape[-1]} rep:{rep_W}")
+
+    def forward(self, x):  # (cin) -> (cout)
+        weight = (self.Qw @ self.weight).reshape(self.nout, self.nin)
+        return F.linear(x, weight, self.Qb @ self.bias)
+
+
+@export
+class ContractionEquivLinear(nn.Module):
+    """ Equivariant Linear layer from repin to repout for O(n), SO(n) and the Lorentz groups,
+        parametrized by the coefficients of the δ/η/ε contraction patterns (see TensorContractions)
+        instead of by a projected dense weight matrix, so no basis is solved for."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.contractions = TensorContractions(repin, repout)
+        for i, c in enumerate(self.contractions.backend_constants()):
+            self.register_buffer(f'constant_{i}', torch.from_numpy(np.asarray(c)))
+        nin = max(repin.size(), 1)
+        self.weight = nn.Parameter(torch.randn(self.contractions.weight_size) / np.sqrt(nin))
+        self.bias = nn.Parameter(torch.randn(self.contractions.bias_size) / np.sqrt(repout.size()))
+        logging.info(f"ContractionEquivLinear coefficients:{self.contractions.weight_size} {repin} -> {repout}")
+
+    def forward(self, x):  # (cin) -> (cout)
+        constants = [getattr(self, f'constant_{i}') for i in range(len(self.contractions.backend_constants()))]
+        return self.contractions(x, self.weight, self.bias, constants, torch.einsum,
+                                 lambda ys: torch.cat(ys, -1), partial(torch.zeros, dtype=x.dtype, device=x.device))
 
-    def proj_w(self, w):
-        return (self.Pw @ w.reshape(-1)).reshape(self.nout, self.nin)
+
+@export
+class ConvolutionEquivLinear(nn.Module):
+    """ Equivariant Linear layer from repin to repout (sums of V and scalars) for ℤₙ and ℤₖ⋉(ℤₙ×ℤₙ),
+        where the maps between the regular representations V are group convolutions with a kernel
+        of |G| parameters per pair of channels, applied with the FFT (see RegularConvolutions)."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.convolutions = RegularConvolutions(repin, repout)
+        for i, c in enumerate(self.convolutions.backend_constants()):
+            self.register_buffer(f'constant_{i}', torch.from_numpy(np.asarray(c)))
+        self.dims = tuple(range(-len(self.convolutions.grid), 0))
+        self.weight = nn.Parameter(torch.randn(self.convolutions.weight_size) / np.sqrt(max(repin.size(), 1)))
+        self.bias = nn.Parameter(torch.randn(self.convolutions.bias_size) / np.sqrt(repout.size()))
+        logging.info(f"ConvolutionEquivLinear coefficients:{self.convolutions.weight_size} {repin} -> {repout}")
+
+    def forward(self, x):  # (cin) -> (cout)
+        constants = [getattr(self, f'constant_{i}') for i in range(len(self.convolutions.backend_constants()))]
+        return self.convolutions(x, self.weight, self.bias, constants, torch.einsum,
+                                 partial(torch.fft.fftn, dim=self.dims), partial(torch.fft.ifftn, dim=self.dims),
+                                 lambda ys: torch.cat(ys, -1), partial(torch.zeros, dtype=x.dtype, device=x.device))
+
+
+@export
+class OrbitEquivLinear(nn.Module):
+    """ Equivariant Linear layer from repin to repout for permutation representations of discrete
+        groups. The equivariant weights are constant on the orbits of the group acting on the entries
+        of W (and of the bias), so the layer stores one parameter per orbit and the int32 orbit label
+        of each entry, and forms W with a single gather instead of projecting a dense weight."""
+
+    def __init__(self, repin, repout):
+        super().__init__()
+        self.nin, self.nout = repin.size(), repout.size()
+        num_w, w_orbits = (repout * repin.T).orbits()
+        num_b, b_orbits = repout.orbits()
+        self.register_buffer('weight_orbits', torch.from_numpy(w_orbits))
+        self.register_buffer('bias_orbits', torch.from_numpy(b_orbits))
+        self.weight = nn.Parameter(torch.randn(num_w) / np.sqrt(self.nin))
+        self.bias = nn.Parameter(torch.randn(num_b) / np.sqrt(self.nout))
+        logging.info(f"OrbitEquivLinear orbits:{num_w} {repin} -> {repout}")
+
+    def forward(self, x):  # (cin) -> (cout)
+        weight = self.weight[self.weight_orbits].reshape(self.nout, self.nin)
+        return F.linear(x, weight, self.bias[self.bias_orbits])
+
+
+@export
+class SeparatedEquivLinear(ProjectedLinear):
+    """ Basic equivariant Linear layer from repin to repout."""
 
     def __init__(self, rep_in, context_rep, rep_out):
         self.nin, self.nout = rep_in.size() + context_rep.size(), rep_out.size()
@@ -171,10 +303,7 @@ class SeparatedEquivLinear(nn.Linear):
         # weight = (self.dense_Pw @ self.weight.reshape(-1)).reshape(self.out_features, self.in_features)
         # bias = self.dense_Pb @ self.bias
 
-        with torch.profiler.record_function('Weight projection'):
-            weight = self.proj_w(self.weight)
-        with torch.profiler.record_function('Bias projection'):
-            bias = self.proj_b(self.bias)
+        weight, bias = self.projected_parameters()
 
         # Slice the weight matrix according to the size of the x and the shape_rep
         left_weight = weight[:, :x.shape[2]]
@@ -186,6 +315,64 @@ class SeparatedEquivLinear(nn.Linear):
         # return F.linear(x, weight, bias)
 
 
+@export
+class ProjectedOptimizer(torch.optim.Optimizer):
+    """ Wraps a torch optimizer (over model.parameters()) to keep the weights of the EquivLinear and
+        SeparatedEquivLinear layers of model in the equivariant subspace by projecting them with Pw
+        and Pb once after every step, rather than projecting them in every forward pass. The layers
+        are switched to use their weights directly (a plain F.linear), so evaluation pays no
+        projection cost at all. Every check_every steps the relative distance of the weights from
+        their projection is checked before the step, and if it exceeds tol (e.g. after the weights
+        were modified outside of the optimizer) a warning is logged, the weights being projected
+        again afterwards. It is a torch Optimizer sharing the param_groups and state of the wrapped
+        optimizer, so it can be used with the torch.optim.lr_scheduler schedules."""
+
+    def __init__(self, model, optimizer, check_every=100, tol=1e-4):
+        super().__init__(optimizer.param_groups, optimizer.defaults)
+        self.param_groups, self.state = optimizer.param_groups, optimizer.state
+        self.optimizer = optimizer
+        self.check_every = check_every
+        self.tol = tol
+        self.steps = 0
+        self.layers = [m for m in model.modules() if isinstance(m, ProjectedLinear)]
+        for layer in self.layers:
+            layer.projected = True
+        self.project()
+
+    @torch.no_grad()
+    def project(self):
+        """ Projects the weights and biases of the layers onto the equivariant subspace."""
+        for layer in self.layers:
+            layer.weight.copy_(layer.proj_w(layer.weight))
+            layer.bias.copy_(layer.proj_b(layer.bias))
+
+    @torch.no_grad()
+    def drift(self):
+        """ The largest relative distance ‖Pw-w‖/‖w‖ of the weights (and biases) from the equivariant subspace."""
+        rel_dist = lambda Pw, w: (torch.linalg.norm(Pw - w) / (torch.linalg.norm(w) + 1e-12)).item()
+        return max([0.] + [d for layer in self.layers for d in (rel_dist(layer.proj_w(layer.weight), layer.weight),
+                                                                rel_dist(layer.proj_b(layer.bias), layer.bias))])
+
+    def step(self, closure=None):
+        if self.check_every and self.steps % self.check_every == 0:
+            drift = self.drift()
+            if drift > self.tol: logging.warning(f"Equivariant weights drifted by {drift:.2e} from their projection")
+        loss = self.optimizer.step(closure)
+        self.project()
+        self.steps += 1
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none)
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+        self.param_groups, self.state = self.optimizer.param_groups, self.optimizer.state
+
+
 @export
 class EquivBiLinear(nn.Module):
     """ Cheap bilinear layer (adds parameters for each part of the input which can be
@@ -299,6 +486,8 @@ class EMLP(nn.Module):
         # assert all((not rep.G is None) for rep in middle_layers[0].reps)
         reps = [self.rep_in] + middle_layers
         # logging.info(f"Reps: {reps}")
+        # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+        SolvePlan([(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], self.rep_out)]).execute()
         self.network = nn.Sequential(
             *[EMLPBlock(rin, rout) for rin, rout in zip(reps, reps[1:])],
             EquivLinear(reps[-1], self.rep_out)
@@ -390,6 +579,9 @@ class FullSeparatedEMLP(nn.Module):
         reps = [self.rep_in] + middle_layers
 
         # logging.info(f"Reps: {reps}")
+        # Solve for all of the bases up front (deduplicated, largest first) before building the layers
+        SolvePlan([(rin + self.context_rep, gated(rout)) for rin, rout in zip(reps, reps[1:])]
+                  + [(reps[-1] + self.context_rep, self.rep_out)]).execute()
 
         self.layers = nn.ModuleList([
             *[SeparatedEMLPBlock(rep_in=rin, context_rep=self.context_rep, rep_out=rout) for rin, rout in zip(reps, reps[1:])],
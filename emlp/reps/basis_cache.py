@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from .basis_store import get_basis_store
+from .linear_operator_base import LinearOperator
+from emlp.utils import export
+
+
+_missing = object()
+
+
+def nbytes(Q):
+    """ Memory footprint of a cached basis (arrays, or lazy operators built from arrays)."""
+    if hasattr(Q, 'nbytes'): return int(Q.nbytes)
+    return sum(nbytes(M) for M in getattr(Q, 'Ms', []))
+
+
+@export
+class BasisCache(object):
+    """ In memory cache of solved equivariant bases with a byte budget. Behaves as a
+        dictionary from canonical representations to bases Q, but once the resident size
+        exceeds max_bytes the least recently used entries are evicted. Evicted entries
+        are spilled to the basis store (if enabled and not already present) so that
+        they can be reloaded cheaply instead of being solved for again.
+
+        All accesses hold a lock, so the cache can be shared with the worker threads of solve_bases.
+
+        Args:
+            max_bytes (int or None): budget for the resident bases, None for no limit
+            spill (bool): whether to write evicted entries to the basis store """
+
+    def __init__(self, max_bytes=None, spill=True):
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._max_bytes = max_bytes
+        self.spill = spill
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.RLock()
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def get(self, rep, default=None):
+        """ Returns the basis for rep (marking it as recently used), or default if absent."""
+        with self._lock:
+            if rep not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(rep)
+            return self._entries[rep]
+
+    def __getitem__(self, rep):
+        Q = self.get(rep, _missing)
+        if Q is _missing: raise KeyError(rep)
+        return Q
+
+    def __setitem__(self, rep, Q):
+        with self._lock:
+            if rep in self._entries: del self[rep]
+            self._entries[rep] = Q
+            self._sizes[rep] = nbytes(Q)
+            self.nbytes += self._sizes[rep]
+            self._evict(keep=rep)
+
+    def __delitem__(self, rep):
+        with self._lock:
+            del self._entries[rep]
+            self.nbytes -= self._sizes.pop(rep)
+
+    def __contains__(self, rep):
+        with self._lock:
+            return rep in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """ A snapshot of the cached representations, from least to most recently used."""
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Dictionary of the cache counters and the resident size in bytes."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self, keep=None):
+        """ Evicts least recently used entries (other than keep) until within the byte budget."""
+        if self.max_bytes is None: return
+        with self._lock:
+            for rep in list(self._entries):
+                if self.nbytes <= self.max_bytes: break
+                if rep == keep: continue
+                Q = self._entries[rep]
+                del self[rep]
+                self.evictions += 1
+                store = get_basis_store()
+                if self.spill and store is not None and rep not in store and not isinstance(Q, LinearOperator):
+                    store.save(rep, Q)
+                logging.debug(f"Evicted basis for {rep} from the cache")
+
+    def __repr__(self):
+        return f"BasisCache({len(self)} entries, {self.nbytes / 2 ** 20:.1f}/" + \
+               (f"{self.max_bytes / 2 ** 20:.1f}MiB)" if self.max_bytes is not None else "∞MiB)")
+
+
+# Byte budget of the default cache, can be set with $EMLP_BASIS_CACHE_BYTES (empty for no limit)
+_max_bytes = os.environ.get('EMLP_BASIS_CACHE_BYTES', str(2 ** 30))
+default_cache = BasisCache(int(float(_max_bytes)) if _max_bytes else None)
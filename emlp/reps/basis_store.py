@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from tempfile import gettempdir
+
+import numpy as np
+from emlp.utils import export
+
+try:
+    import fcntl
+except ImportError:  # No advisory locking available (e.g. Windows), fall back to atomic renames only
+    fcntl = None
+
+STORE_VERSION = 3  # Bump to invalidate stored solutions when the solver output format changes
+
+
+@export
+class BasisStore(object):
+    """ A persistent, content addressed store for solved equivariant bases Q.
+        Entries are keyed by a fingerprint of the canonical representation and
+        of its symmetry group, and are stored as raw .npy files so that they can
+        be loaded back zero-copy as read only memory maps. Writes go through a
+        temporary file and an atomic rename so that several processes can
+        share the same store.
+
+        Args:
+            root (str): directory in which the bases and the manifest are kept """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, rep):
+        """ Fingerprint identifying the solution of the (canonical) representation rep."""
+        return hashlib.sha256(f"v{STORE_VERSION}|{rep.fingerprint()}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def __contains__(self, rep):
+        return os.path.exists(self.path(self.key(rep)))
+
+    def load(self, rep):
+        """ Returns the stored basis for rep as a read only memory map, or None if absent."""
+        path = self.path(self.key(rep))
+        if not os.path.exists(path): return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (ValueError, OSError) as e:
+            logging.warning(f"Ignoring unreadable basis store entry {path}: {e}")
+            return None
+
+    def save(self, rep, Q):
+        """ Atomically writes the basis Q (N,r) for rep to the store."""
+        key = self.key(rep)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._atomic_write(path, lambda f: np.save(f, np.asarray(Q)))
+        entry = {'rep': str(rep), 'group': str(getattr(rep, 'G', None)), 'shape': list(np.shape(Q)),
+                 'dtype': str(np.asarray(Q).dtype), 'file': os.path.relpath(path, self.root)}
+        with self._lock():
+            manifest = self.manifest()
+            manifest[key] = entry
+            self._atomic_write(self._manifest_path, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+        logging.info(f"Stored basis for {rep} at {path}")
+
+    def checkpoint(self, rep, interval=60):
+        """ SolveCheckpoint for the iterative solve of the (canonical) representation rep."""
+        return SolveCheckpoint(self, self.key(rep), interval)
+
+    def manifest(self):
+        """ Dictionary of the entries in the store (key -> description)."""
+        try:
+            with open(self._manifest_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def clear(self):
+        """ Removes all stored bases."""
+        with self._lock():
+            for key in self.manifest():
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+            try:
+                os.remove(self._manifest_path)
+            except OSError:
+                pass
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def _atomic_write(self, path, write_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, 'manifest.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def __repr__(self):
+        return f"BasisStore({self.root!r})"
+
+
+@export
+class SolveCheckpoint(object):
+    """ Periodic checkpoint of the state of an iterative constraint solve, kept in the
+        basis store under the fingerprint of the representation being solved. A solve
+        that is restarted (e.g. after preemption) resumes from the last checkpoint.
+
+        Args:
+            store (BasisStore): store holding the checkpoint
+            key (str): fingerprint of the representation being solved
+            interval (float): minimum number of seconds between checkpoints """
+
+    def __init__(self, store, key, interval=60):
+        self.store = store
+        self.path = os.path.join(store.root, 'checkpoints', key + '.npz')
+        self.interval = interval
+        self.last_saved = time.time()
+
+    def due(self):
+        """ Whether interval seconds have elapsed since the last checkpoint."""
+        return time.time() - self.last_saved > self.interval
+
+    def save(self, **state):
+        """ Atomically writes the solver state (arrays and scalars) as the latest checkpoint."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.store._atomic_write(self.path, lambda f: np.savez(f, **{k: np.asarray(v) for k, v in state.items()}))
+        self.last_saved = time.time()
+        logging.debug(f"Saved solver checkpoint {self.path}")
+
+    def load(self):
+        """ Returns the state of the last checkpoint as a dictionary, or None if absent."""
+        if not os.path.exists(self.path): return None
+        try:
+            with np.load(self.path) as data:
+                return {k: data[k] for k in data.files}
+        except (ValueError, OSError) as e:
+            logging.warning(f"Ignoring unreadable solver checkpoint {self.path}: {e}")
+            return None
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# Cross-platform default location, can be overridden (or disabled with an empty string) by $EMLP_BASIS_STORE
+_store_root = os.environ.get('EMLP_BASIS_STORE', os.path.join(gettempdir(), 'emlp_basis_store'))
+_basis_store = BasisStore(_store_root) if _store_root else None
+
+
+@export
+def get_basis_store():
+    """ The BasisStore used by Rep.equivariant_basis (None if disabled)."""
+    return _basis_store
+
+
+@export
+def set_basis_store(store):
+    """ Sets the BasisStore used by Rep.equivariant_basis. Accepts a BasisStore,
+        a directory path, or None to disable the persistent store."""
+    global _basis_store
+    _basis_store = BasisStore(store) if isinstance(store, str) else store
+    return _basis_store
@@ -0,0 +1,183 @@
+import itertools
+import string
+import numpy as np
+from .representation import Base, Dual, ScalarRep
+from .product_sum_reps import SumRep, ProductRep
+import emlp.groups
+from emlp.utils import export
+
+__all__ = []
+
+
+@export
+def invariant_form(G):
+    """ The metric η and whether the Levi-Civita symbol ε is also invariant, for the groups whose
+        invariant tensors are all generated by η (and ε) under products and contractions (the first
+        fundamental theorem of invariant theory for the orthogonal and indefinite orthogonal groups).
+        Returns (η,special) or None if the group is not one of O(n),SO(n),O(1,3),SO(1,3),O(1,1),SO(1,1)."""
+    groups = emlp.groups
+    if isinstance(G, groups.SO):
+        return np.eye(G.d), not isinstance(G, groups.O)
+    if isinstance(G, groups.SO13p):
+        return np.diag([-1., 1., 1., 1.]), not isinstance(G, groups.O13)
+    if isinstance(G, groups.SO11p):
+        return np.diag([-1., 1.]), not isinstance(G, groups.O11)
+    return None
+
+
+def levi_civita(n):
+    """ The Levi-Civita symbol ε as a dense (n,)*n array."""
+    eps = np.zeros((n,) * n)
+    for sigma in itertools.permutations(range(n)):
+        inversions = sum(sigma[i] > sigma[j] for i in range(n) for j in range(i + 1, n))
+        eps[sigma] = (-1.) ** inversions
+    return eps
+
+
+def perfect_matchings(slots):
+    """ All the ways of splitting slots into pairs."""
+    if not slots:
+        yield []
+        return
+    first, rest = slots[0], slots[1:]
+    for i, other in enumerate(rest):
+        for matching in perfect_matchings(rest[:i] + rest[i + 1:]):
+            yield [(first, other)] + matching
+
+
+def contraction_patterns(num_slots, n, special):
+    """ The δ/η contraction patterns of num_slots tensor indices, each a pair (ε slots,pairs) with the
+        (at most one) group of n slots contracted against ε if special and the pairs of slots
+        contracted against each other. Products of two ε are themselves sums of δ's and are not needed."""
+    slots = list(range(num_slots))
+    patterns = [((), matching) for matching in perfect_matchings(slots)]
+    if special:
+        for eps_slots in itertools.combinations(slots, n):
+            rest = [s for s in slots if s not in eps_slots]
+            patterns.extend((eps_slots, matching) for matching in perfect_matchings(rest))
+    return patterns
+
+
+def tensor_slots(rep):
+    """ The variance of each tensor index of rep (True for V, False for V*), or None if
+        rep is not a tensor product of V and V*."""
+    if isinstance(rep, ScalarRep): return []
+    if type(rep) == Base: return [True]
+    if type(rep) == Dual and type(rep.rep) == Base: return [False]
+    if type(rep) == ProductRep:
+        slots = [tensor_slots(r) for r, c in rep.reps.items() for _ in range(c)]
+        return None if None in slots else sum(slots, [])
+    return None
+
+
+def tensor_blocks(rep):
+    """ The blocks (start,stop,multiplicity,slots) of the canonical ordering of rep and the permutation
+        to the canonical ordering."""
+    canonical, perm = rep.canonicalize()
+    counter = canonical.reps if isinstance(canonical, SumRep) else {canonical: 1}
+    blocks, start = [], 0
+    for r, c in counter.items():
+        slots = tensor_slots(r)
+        if slots is None:
+            raise NotImplementedError(f"Contraction layers only support sums of tensors of V and V*, not {r}")
+        blocks.append((start, start + c * r.size(), c, slots))
+        start += c * r.size()
+    return blocks, perm
+
+
+@export
+class TensorContractions(object):
+    """ The equivariant linear maps from repin to repout for the groups with an invariant_form,
+        enumerated symbolically as the δ/η (and ε) contraction patterns between the input and output
+        tensor indices of each pair of (canonical) tensor blocks. The layer weights are the (possibly
+        redundant) coefficients of the patterns for each pair of channels, and the map is evaluated
+        as a sum of einsum contractions, without forming any n^(p+q) sized projector or solving for a basis.
+        A V index and a V* index are contracted with δ, two indices of the same type with η."""
+
+    def __init__(self, repin, repout):
+        reps = [r for rep in (repin, repout) for r in (rep.reps if isinstance(rep, SumRep) else [rep])]
+        G = next((r.G for r in reps if getattr(r, 'G', None) is not None), None)
+        form = invariant_form(G)
+        if form is None:
+            raise NotImplementedError(f"Contraction layers are not available for the group {G}")
+        eta, special = form
+        self.n = n = len(eta)
+        euclidean = (eta == np.eye(n)).all()
+        self.in_blocks, self.in_perm = tensor_blocks(repin)
+        out_blocks, out_perm = tensor_blocks(repout)
+        self.out_blocks, self.out_invperm = out_blocks, np.argsort(out_perm)
+        self.constants = [np.eye(n, dtype=np.float32), eta.astype(np.float32)]
+        if special: self.constants.append(levi_civita(n).astype(np.float32))
+        self.weight_terms, self.weight_size = [], 0  # (out block,in block,offset,shape,[(subscripts,constant ids)])
+        for o, (_, _, cout, out_slots) in enumerate(self.out_blocks):
+            for i, (_, _, cin, in_slots) in enumerate(self.in_blocks):
+                # Indices of the input are contracted with the weight tensor, so the variance flips
+                slots = out_slots + [not up for up in in_slots]
+                terms = [self._subscripts(pattern, slots, len(out_slots), euclidean)
+                         for pattern in contraction_patterns(len(slots), n, special)]
+                if not terms: continue
+                shape = (len(terms), cout, cin)
+                self.weight_terms.append((o, i, self.weight_size, shape, terms))
+                self.weight_size += int(np.prod(shape))
+        self.bias_terms, self.bias_size = [], 0  # (out block,offset,shape,invariant tensors)
+        for o, (_, _, cout, out_slots) in enumerate(self.out_blocks):
+            patterns = contraction_patterns(len(out_slots), n, special)
+            if not patterns: continue
+            tensors = np.stack([self._invariant_tensor(pattern, out_slots, euclidean) for pattern in patterns])
+            self.bias_terms.append((o, self.bias_size, (len(patterns), cout),
+                                    tensors.reshape(len(patterns), -1).astype(np.float32)))
+            self.bias_size += len(patterns) * cout
+
+    def _subscripts(self, pattern, slots, num_out, euclidean):
+        """ The einsum subscripts '...ci..,oc,constants->...oj..' of a contraction pattern, with
+            the constants given by their index in self.constants."""
+        letters = iter(string.ascii_letters)
+        cout, cin = next(letters), next(letters)
+        slot_letters = [next(letters) for _ in slots]
+        operands = []
+        eps_slots, pairs = pattern
+        if eps_slots:  # ε is invariant with all indices of the same type, the V indices are lowered with η
+            raised = {s: next(letters) if slots[s] and not euclidean else slot_letters[s] for s in eps_slots}
+            operands.append((2, ''.join(raised[s] for s in eps_slots)))
+            operands.extend((1, raised[s] + slot_letters[s]) for s in eps_slots if raised[s] != slot_letters[s])
+        for s, t in pairs:
+            if slots[s] == slots[t] and not euclidean:
+                operands.append((1, slot_letters[s] + slot_letters[t]))
+            elif t >= num_out:  # δ with an input index is a relabelling of that index (or a trace)
+                slot_letters[t] = slot_letters[s]
+            else:
+                operands.append((0, slot_letters[s] + slot_letters[t]))
+        inputs = ['...' + cin + ''.join(slot_letters[num_out:]), cout + cin] + [subs for _, subs in operands]
+        output = '...' + cout + ''.join(slot_letters[:num_out])
+        return ','.join(inputs) + '->' + output, [c for c, _ in operands]
+
+    def _invariant_tensor(self, pattern, slots, euclidean):
+        """ The dense invariant tensor of a contraction pattern of the output indices alone."""
+        subscripts, constants = self._subscripts(pattern, slots, len(slots), euclidean)
+        inputs, output = subscripts.split('->')
+        inputs = inputs.split(',')[2:]
+        if not inputs: return np.ones(())
+        return np.einsum(','.join(inputs) + '->' + output[4:], *[self.constants[c] for c in constants])
+
+    def __call__(self, x, w, b, constants, einsum, concatenate, zeros):
+        """ Applies the linear map with the flat weight and bias coefficients w and b to x (...,nin),
+            using the array functions of the backend (jnp or torch) and the constants converted to it."""
+        batch = x.shape[:-1]
+        x = x[..., self.in_perm]
+        xs = [x[..., start:stop].reshape(*batch, c, *(self.n,) * len(slots))
+              for start, stop, c, slots in self.in_blocks]
+        ys = [None] * len(self.out_blocks)
+        for o, i, offset, shape, terms in self.weight_terms:
+            W = w[offset:offset + int(np.prod(shape))].reshape(*shape)
+            for p, (subscripts, ids) in enumerate(terms):
+                y = einsum(subscripts, xs[i], W[p], *[constants[c] for c in ids])
+                ys[o] = y if ys[o] is None else ys[o] + y
+        ys = [zeros((*batch, stop - start)) if y is None else y.reshape(*batch, stop - start)
+              for y, (start, stop, _, _) in zip(ys, self.out_blocks)]
+        for (o, offset, shape, tensors), tensor in zip(self.bias_terms, constants[len(self.constants):]):
+            ys[o] = ys[o] + (b[offset:offset + int(np.prod(shape))].reshape(*shape).T @ tensor).reshape(-1)
+        return concatenate(ys)[..., self.out_invperm]
+
+    def backend_constants(self):
+        """ The numpy constants used by __call__: the metric, ε and the invariant tensors for the bias."""
+        return self.constants + [tensors for _, _, _, tensors in self.bias_terms]
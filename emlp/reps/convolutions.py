@@ -0,0 +1,107 @@
+import numpy as np
+from .product_sum_reps import SumRep
+from .contractions import tensor_blocks
+import emlp.groups
+from emlp.utils import export
+
+__all__ = []
+
+
+@export
+def regular_grid(G):
+    """ The translation grid shape, the order k of the rotations and the number of quarter turns per
+        rotation for the groups whose base representation is the regular representation of a
+        (rotation ⋉ translation) group, ℤₙ and ℤₖ⋉(ℤₙ×ℤₙ). Returns None for other groups."""
+    groups = emlp.groups
+    if isinstance(G, groups.Z):
+        return (G.d,), 1, 0
+    if isinstance(G, groups.ZksZnxZn):
+        k, n = G.args
+        return (n, n), k, 4 // k
+    return None
+
+
+def rotation_indices(grid, k, quarter_turns):
+    """ Flat indices P (k,n^d) with K[P[s]] the kernel K rotated s times about the origin of the
+        (periodic) grid. Rotating a kernel permutes the frequencies of its DFT in the same way."""
+    ids = np.arange(np.prod(grid)).reshape(grid)
+    P = [ids.reshape(-1)]
+    for _ in range(k - 1):
+        for _ in range(quarter_turns):  # the origin centered version of np.rot90, (i,j) -> (j,-i)
+            ids = np.roll(np.rot90(ids), 1, axis=0)
+        P.append(ids.reshape(-1))
+    return np.stack(P)
+
+
+@export
+class RegularConvolutions(object):
+    """ The equivariant linear maps between sums of scalars and copies of the (regular) base
+        representation of ℤₙ or ℤₖ⋉(ℤₙ×ℤₙ). Between two regular representations these are the
+        group convolutions: for each pair of rotations (r,r') a circular convolution over the grid
+        with the kernel K_{r-r'} rotated r' times, so each pair of channels has a kernel K (k,*grid)
+        of |G| parameters. The convolutions are evaluated with the FFT in O(|G|log|G|) instead of the
+        O(|G|²) of a dense matrix, and neither a projector nor a basis is ever formed.
+        Maps to and from scalars are the broadcast and the sum over the group."""
+
+    def __init__(self, repin, repout):
+        reps = [r for rep in (repin, repout) for r in (rep.reps if isinstance(rep, SumRep) else [rep])]
+        G = next((r.G for r in reps if getattr(r, 'G', None) is not None), None)
+        grid = regular_grid(G)
+        if grid is None:
+            raise NotImplementedError(f"Convolution layers are not available for the group {G}")
+        self.grid, self.k, quarter_turns = grid
+        self.in_blocks, self.in_perm = tensor_blocks(repin)
+        out_blocks, out_perm = tensor_blocks(repout)
+        self.out_blocks, self.out_invperm = out_blocks, np.argsort(out_perm)
+        for start, stop, c, slots in self.in_blocks + self.out_blocks:
+            if len(slots) > 1 or False in slots:
+                raise NotImplementedError(f"Convolution layers only support sums of V and scalars")
+        self.weight_terms, self.weight_size = [], 0  # (out block,in block,offset,shape)
+        for o, (_, _, cout, out_slots) in enumerate(self.out_blocks):
+            for i, (_, _, cin, in_slots) in enumerate(self.in_blocks):
+                shape = (cout, cin, self.k, *self.grid) if out_slots and in_slots else (cout, cin)
+                self.weight_terms.append((o, i, self.weight_size, shape))
+                self.weight_size += int(np.prod(shape))
+        self.bias_terms, self.bias_size = [], 0  # (out block,offset,shape)
+        for o, (_, _, cout, _) in enumerate(self.out_blocks):
+            self.bias_terms.append((o, self.bias_size, (cout,)))
+            self.bias_size += cout
+        rotations = rotation_indices(self.grid, self.k, quarter_turns)
+        r = np.arange(self.k)
+        self.constants = [(r[:, None] - r[None, :]) % self.k, rotations, np.ones(self.k * int(np.prod(self.grid)), dtype=np.float32)]
+
+    def __call__(self, x, w, b, constants, einsum, fft, ifft, concatenate, zeros):
+        """ Applies the linear map with the flat weight and bias coefficients w and b to x (...,nin),
+            using the array functions of the backend (jnp or torch) and the constants converted to it.
+            fft and ifft transform the last d axes of an array."""
+        offsets, rotations, ones = constants
+        batch, size = x.shape[:-1], len(self.constants[2])
+        x = x[..., self.in_perm]
+        xs = [x[..., start:stop].reshape(*batch, c, *((self.k, *self.grid) if slots else ()))
+              for start, stop, c, slots in self.in_blocks]
+        xfs = [fft(x) if slots else None for x, (_, _, _, slots) in zip(xs, self.in_blocks)]
+        ys = [None] * len(self.out_blocks)
+        for o, i, offset, shape in self.weight_terms:
+            W = w[offset:offset + int(np.prod(shape))].reshape(*shape)
+            if len(shape) > 2:  # group convolution in the Fourier domain
+                K = fft(W).reshape(*shape[:3], -1)[:, :, offsets[:, :, None], rotations[None, :, :]]
+                X = xfs[i].reshape(*batch, shape[1], self.k, -1)
+                y = ifft(einsum('ocrsf,...csf->...orf', K, X).reshape(*batch, shape[0], self.k, *self.grid)).real
+            elif self.out_blocks[o][3]:  # broadcast of scalars
+                y = einsum('oc,...c->...o', W, xs[i])[..., None] * ones
+            elif self.in_blocks[i][3]:  # sum over the group
+                y = einsum('oc,...c->...o', W, xs[i].reshape(*batch, shape[1], size).sum(-1))
+            else:
+                y = einsum('oc,...c->...o', W, xs[i])
+            y = y.reshape(*batch, -1)
+            ys[o] = y if ys[o] is None else ys[o] + y
+        ys = [zeros((*batch, stop - start)) if y is None else y for y, (start, stop, _, _) in zip(ys, self.out_blocks)]
+        for o, offset, shape in self.bias_terms:
+            bias = b[offset:offset + shape[0]]
+            ys[o] = ys[o] + ((bias[:, None] * ones).reshape(-1) if self.out_blocks[o][3] else bias)
+        return concatenate(ys)[..., self.out_invperm]
+
+    def backend_constants(self):
+        """ The numpy constants used by __call__: the rotation offsets r-r', the rotations of
+            the kernels in the Fourier domain and the constant vector on the group."""
+        return self.constants
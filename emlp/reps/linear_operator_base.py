@@ -37,6 +37,11 @@ import warnings
 import jax.numpy as np
 import numpy as onp
 
+try:
+    from jax import Array as DeviceArray
+except ImportError:  # jax<0.4 only has the (since removed) jax.numpy.DeviceArray
+    DeviceArray = np.DeviceArray
+
 __all__ = ['LinearOperator', 'aslinearoperator']
 
 import torch
@@ -746,7 +751,7 @@ class Lazy(LinearOperator):
         if isinstance(self.A, onp.ndarray):
             # dbg('Lazy: dense_matrix is a numpy array, converting to Tensor')
             self._A_torch = torch.tensor(self.A, device=device)
-        elif isinstance(self.A, np.DeviceArray):
+        elif isinstance(self.A, DeviceArray):
             # dbg('Lazy: dense_matrix is a DeviceArray, converting to Tensor')
             self._A_torch = torch.tensor(onp.asarray(self.A), device=device)
 
@@ -243,6 +243,57 @@ class LazyPerm(LinearOperator):
         return self
 
 
+class LazyGather(LinearOperator):
+    """ Sparse (N,m) matrix with a single nonzero entry weights[i] in column cols[i] of each
+        row i, so that M@v = weights*v[cols] and Mᵀ@w sums the weighted rows into the columns."""
+
+    def __init__(self, cols, weights, m):
+        self.cols = cols
+        self.weights = weights
+        shape = (len(cols), m)
+        super().__init__(None, shape)
+
+    def _matmat(self, V):
+        return V[self.cols] * self.weights[:, None]
+
+    def _matvec(self, V):
+        return V.reshape(-1)[self.cols] * self.weights
+
+    def _rmatmat(self, V):
+        return jax.ops.segment_sum(V * self.weights[:, None], self.cols, num_segments=self.shape[1])
+
+    def _rmatvec(self, V):
+        return jax.ops.segment_sum(V.reshape(-1) * self.weights, self.cols, num_segments=self.shape[1])
+
+
+class LazyOrbitBasis(LinearOperator):
+    """ Sparse (N,d) basis made of blocks (entries,U) of o orbits each: the rows entries[p] (m,) of
+        orbit p hold their own r columns with the values U (m,r), so that only the integer entries
+        and the small dense U are stored. The columns are ordered by block, then orbit, then column of U."""
+
+    def __init__(self, blocks, N):
+        self.blocks = blocks
+        self.sizes = [len(entries) * U.shape[-1] for entries, U in blocks]
+        super().__init__(None, (N, sum(self.sizes)))
+
+    def _matmat(self, V):
+        Vs = jnp.split(V, np.cumsum(self.sizes)[:-1])
+        values = [jnp.einsum('wr,orc->owc', U, Vi.reshape(len(entries), U.shape[-1], -1)).reshape(-1, V.shape[-1])
+                  for (entries, U), Vi in zip(self.blocks, Vs)]
+        rows = np.concatenate([entries.reshape(-1) for entries, _ in self.blocks])
+        return jnp.zeros((self.shape[0], V.shape[-1]), dtype=values[0].dtype).at[rows].set(jnp.concatenate(values))
+
+    def _matvec(self, V):
+        return self._matmat(V.reshape(-1, 1)).reshape(-1)
+
+    def _rmatmat(self, V):
+        return jnp.concatenate([jnp.einsum('wr,owc->orc', U, V[entries]).reshape(-1, V.shape[-1])
+                                for entries, U in self.blocks])
+
+    def _rmatvec(self, V):
+        return self._rmatmat(V.reshape(-1, 1)).reshape(-1)
+
+
 class LazyShift(LinearOperator):
     def __init__(self, n, k=1):
         self.k = k
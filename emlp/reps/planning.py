@@ -0,0 +1,56 @@
+import logging
+from .representation import Rep, solve_bases, solve_cost
+from .basis_store import get_basis_store
+from emlp.utils import export
+
+
+@export
+class SolvePlan(object):
+    """ Collects the equivariant basis solves needed to construct a model so that they
+        can be carried out at once before the layers are built. The weight and bias
+        representations of all layers are broken up into their canonical components,
+        deduplicated and ordered by estimated solve cost (largest first), so that each
+        unique block is solved exactly once and the solves can be spread across the
+        executors in representation.parallel_options.
+
+        Args:
+            layers (iterable[(Rep,Rep)]): (repin, repout) pairs of the linear layers """
+
+    def __init__(self, layers=()):
+        self.components = {}
+        for repin, repout in layers:
+            self.add_linear(repin, repout)
+
+    def add(self, rep):
+        """ Adds the solves needed for the basis of rep to the plan."""
+        for leaf in rep.basis_components():
+            self.components[leaf] = solve_cost(leaf)
+        return self
+
+    def add_linear(self, repin, repout):
+        """ Adds the solves for the weights (repin → repout) and the bias (repout) of a linear layer."""
+        return self.add(repout * repin.T).add(repout)
+
+    @property
+    def schedule(self):
+        """ The unique canonical representations to be solved for, largest first."""
+        return sorted(self.components, key=self.components.get, reverse=True)
+
+    def pending(self):
+        """ The scheduled representations that are neither cached in memory nor in the basis store."""
+        store = get_basis_store()
+        return [rep for rep in self.schedule if rep not in Rep.solcache and (store is None or rep not in store)]
+
+    def execute(self):
+        """ Solves for (or loads) all of the bases in the plan and places them in Rep.solcache."""
+        pending = self.pending()
+        logging.info(f"Solve plan: {len(self.components)} unique blocks, {len(pending)} to solve "
+                     f"with estimated cost {sum(self.components[rep] for rep in pending):.2e}")
+        solve_bases(self.schedule)
+        return self
+
+    def __len__(self):
+        return len(self.components)
+
+    def __repr__(self):
+        return f"SolvePlan({', '.join(str(rep) for rep in self.schedule)})"
@@ -0,0 +1,88 @@
+from scipy.special import comb
+import numpy as np
+from .representation import Rep
+from .linear_operators import LazyKron, LazyKronsum, LazyGather
+from .symmetric_group import power_embedding
+from emlp.utils import export
+
+__all__ = ["Sym", "Wedge"]
+
+
+@export
+class SymmetricPower(Rep):
+    """ Symmetric power Symᵏ(V) of a representation V, the subspace of symmetric tensors
+        of V^⊗k. Vectors hold only the C(n+k-1,k) independent components, coordinate j being
+        the coefficient of the normalized symmetrization of the j-th sorted multi-index of the
+        (canonically ordered) rep, so the inner product matches that of the full tensors.
+        ρ(g) and dρ(A) are the restrictions Bᵀρ(g)^⊗kB and Bᵀ(⊕dρ(A))B of the tensor power
+        to the embedding B = tensor_embedding()."""
+    antisymmetric = False
+
+    def __init__(self, rep, k):
+        super().__init__()
+        self.rep = rep.canonicalize()[0] if rep.concrete else rep
+        self.k = k
+        self.G = getattr(rep, 'G', None)
+        if self.G is None and hasattr(rep, 'reps'):  # sums of representations take the group of their summands
+            self.G = next((r.G for r in rep.reps if getattr(r, 'G', None) is not None), None)
+        self.is_permutation = bool(rep.is_permutation) and not self.antisymmetric
+
+    def __call__(self, G):
+        return self.__class__(self.rep(G), self.k)
+
+    def size(self):
+        n = self.rep.size()
+        return comb(n, self.k, exact=True) if self.antisymmetric else comb(n + self.k - 1, self.k, exact=True)
+
+    def tensor_embedding(self):
+        """ The (lazy) isometric embedding B (n^k,size) into the tensor power of rep, vectors
+            x of this rep correspond to the tensors Bx and tensors t are projected with Bᵀt."""
+        cols, weights = power_embedding(self.rep.size(), self.k, self.antisymmetric)
+        return LazyGather(cols, weights, self.size())
+
+    def rho(self, M):
+        B = self.tensor_embedding()
+        return B.H @ LazyKron([self.rep.rho(M) for _ in range(self.k)]) @ B
+
+    def drho(self, A):
+        B = self.tensor_embedding()
+        return B.H @ LazyKronsum([self.rep.drho(A) for _ in range(self.k)]) @ B
+
+    def character(self, gs):
+        """ Computed from the power sums pⱼ=χ(gʲ) of the character of rep with the Newton identities
+            k·hₖ = Σⱼpⱼhₖ₋ⱼ for the symmetric power and k·eₖ = Σⱼ(-1)ʲ⁻¹pⱼeₖ₋ⱼ for the exterior power."""
+        gs = np.asarray(gs)
+        p = [self.rep.character(np.linalg.matrix_power(gs, j)) for j in range(1, self.k + 1)]
+        sign = -1 if self.antisymmetric else 1
+        h = [np.ones(len(gs))]
+        for i in range(1, self.k + 1):
+            h.append(sum(sign ** (j - 1) * p[j - 1] * h[i - j] for j in range(1, i + 1)) / i)
+        return h[self.k]
+
+    @property
+    def T(self):
+        return self.__class__(self.rep.T, self.k)
+
+    def __str__(self):
+        superscript = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
+        return f"{'∧' if self.antisymmetric else 'Sym'}{str(self.k).translate(superscript)}({self.rep})"
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, other):
+        return type(other) == type(self) and self.rep == other.rep and self.k == other.k
+
+    def __hash__(self):
+        return hash((type(self), self.rep, self.k))
+
+
+@export
+class ExteriorPower(SymmetricPower):
+    """ Exterior power ∧ᵏ(V) of a representation V, the subspace of antisymmetric tensors
+        of V^⊗k, holding only the C(n,k) independent components (see SymmetricPower)."""
+    antisymmetric = True
+
+
+Sym = SymmetricPower  #: Alias Sym(rep,k) for the symmetric power of rep
+Wedge = ExteriorPower  #: Alias Wedge(rep,k) for the exterior power of rep
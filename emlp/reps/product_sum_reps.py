@@ -3,7 +3,7 @@ import jax
 from jax import jit
 import collections, itertools
 from functools import lru_cache as cache
-from .representation import Rep, ScalarRep, Scalar
+from .representation import Rep, ScalarRep, Scalar, solve_bases
 from .linear_operator_base import LinearOperator
 from .linear_operators import LazyPerm, LazyDirectSum, LazyKron, LazyKronsum, I, lazy_direct_matmat, lazify, product, \
     torch_lazy_direct_matmat
@@ -11,6 +11,7 @@ from functools import reduce
 from collections import defaultdict
 from plum import dispatch
 from emlp.utils import memory
+from .symmetric_group import tensor_power_components
 
 
 class TorchLazyP:
@@ -24,6 +25,16 @@ class TorchLazyP:
         return torch_lazy_direct_matmat(array[self.perm], self.Ps_values, self.multiplicities)[self.invperm]
 
 
+class TorchLazyQ:
+    def __init__(self, Qs_values, multiplicities, invperm):
+        self.Qs_values = Qs_values
+        self.multiplicities = multiplicities
+        self.invperm = invperm
+
+    def __call__(self, array):
+        return torch_lazy_direct_matmat(array, self.Qs_values, self.multiplicities)[self.invperm]
+
+
 class SumRep(Rep):
     def __init__(self, *reps, extra_perm=None):  # repcounter,repperm=None):
         super().__init__()
@@ -88,9 +99,30 @@ class SumRep(Rep):
     def concrete(self):
         return True
 
+    def basis_components(self):
+        return [leaf for rep in self.reps for leaf in rep.basis_components()]
+
+    def character(self, gs):
+        return sum(count * rep.character(gs) for rep, count in self.reps.items())
+
+    def invariant_dimension(self, closed_form=False):
+        dims = [rep.invariant_dimension(closed_form) for rep in self.reps]
+        return None if None in dims else sum(count * dim for dim, count in zip(dims, self.reps.values()))
+
+    def orbits(self):
+        """ The orbits of the summands, with each copy of a summand getting its own orbit labels."""
+        labels, num_orbits = [], 0
+        for rep, count in self.reps.items():
+            rep_orbits, rep_labels = rep.orbits()
+            for _ in range(count):
+                labels.append(rep_labels + num_orbits)
+                num_orbits += rep_orbits
+        return num_orbits, np.concatenate(labels)[self.invperm]
+
     def equivariant_basis(self):
         """ Overrides default implementation with a more efficient version which decomposes the constraints
             across the sum."""
+        solve_bases(self.basis_components())
         Qs = {rep: rep.equivariant_basis() for rep in self.reps}
         Qs = {rep: (jax.device_put(Q.astype(np.float32)) if isinstance(Q, (np.ndarray)) else Q) for rep, Q in
               Qs.items()}
@@ -105,6 +137,7 @@ class SumRep(Rep):
     def equivariant_projector(self):
         """ Overrides default implementation with a more efficient version which decomposes the constraints
             across the sum."""
+        solve_bases(self.basis_components())
         Ps = {rep: rep.equivariant_projector() for rep in self.reps}
         multiplicities = self.reps.values()
 
@@ -116,6 +149,7 @@ class SumRep(Rep):
     def torch_equivariant_projector(self):
         """ Overrides default implementation with a more efficient version which decomposes the constraints
             across the sum."""
+        solve_bases(self.basis_components())
         Ps = {rep: rep.equivariant_projector() for rep in self.reps}
         multiplicities = list(self.reps.values())
 
@@ -126,6 +160,19 @@ class SumRep(Rep):
 
         return LinearOperator(shape=(self.size(), self.size()), matvec=lazy_P, matmat=lazy_P)
 
+    def torch_equivariant_basis(self):
+        """ Basis Q (N,r) of the sum that can be applied to torch tensors, for layers that
+            parametrize the weights by their coefficients in the basis."""
+        solve_bases(self.basis_components())
+        Qs = {}
+        for rep in self.reps:  # dense bases are passed as numpy arrays, which Lazy converts to torch
+            Q = rep.equivariant_basis()
+            Qs[rep] = lazify(Q if isinstance(Q, LinearOperator) else np.asarray(Q))
+        multiplicities = list(self.reps.values())
+        active_dims = sum([self.reps[rep] * Qs[rep].shape[-1] for rep in Qs.keys()])
+        lazy_Q = TorchLazyQ(list(Qs.values()), multiplicities, self.invperm)
+        return LinearOperator(shape=(self.size(), active_dims), matvec=lazy_Q, matmat=lazy_Q)
+
     # ##TODO: investigate why these more idiomatic definitions with Lazy Operators end up slower
     # def equivariant_basis(self):
     #     Qs = [rep.equivariant_basis() for rep in self.reps]
@@ -305,6 +352,9 @@ class ProductRep(Rep):
         self.G = Gs[0]
         self.is_permutation = all(rep.is_permutation for rep in self.reps.keys())
 
+    def __call__(self, G):
+        return self.__class__(*[rep(G) for rep, c in self.reps.items() for _ in range(c)], extra_perm=self.perm)
+
     def size(self):
         return product([rep.size() ** count for rep, count in self.reps.items()])
 
@@ -318,6 +368,44 @@ class ProductRep(Rep):
         canonical_lazy = LazyKronsum([rep.drho(As) for rep, c in self.reps.items() for _ in range(c)])
         return LazyPerm(self.invperm) @ canonical_lazy @ LazyPerm(self.perm)
 
+    def character(self, gs):
+        return product([rep.character(gs) ** count for rep, count in self.reps.items()])
+
+    def factorize(self):
+        if not self.canonical or type(self) != ProductRep: return None
+        axes = [rep.factorize() for rep, c in self.reps.items() for _ in range(c)]
+        if None in axes: return None
+        reps1, reps2 = zip(*[reps for reps, _ in axes])
+        sizes1, sizes2 = [rep.size() for rep in reps1], [rep.size() for rep in reps2]
+        # Index of the Kronecker product of the factors, for each entry of the tensor V₁⊗V₂⊗V₁⊗V₂...
+        k = len(axes)
+        kron_ids = np.arange(product(sizes1) * product(sizes2)).reshape(*sizes1, *sizes2)
+        kron_ids = kron_ids.transpose([i for j in range(k) for i in (j, k + j)])
+        kron_ids = kron_ids.reshape([s1 * s2 for s1, s2 in zip(sizes1, sizes2)])[np.ix_(*[perm for _, perm in axes])]
+        factor = lambda reps: reps[0] if k == 1 else ProductRep(*reps)
+        return (factor(reps1), factor(reps2)), kron_ids.reshape(-1)
+
+    def restrict_embedding(self):
+        if not self.canonical or type(self) != ProductRep: return None
+        axes = [rep.restrict_embedding() for rep, c in self.reps.items() for _ in range(c)]
+        if None in axes: return None
+        ids = np.arange(self.size()).reshape([len(perm) for _, perm in axes])
+        return reduce(lambda a, b: a * b, [rep for rep, _ in axes]), ids[np.ix_(*[perm for _, perm in axes])].reshape(-1)
+
+    def isotypic_components(self):
+        if not self.canonical or type(self) != ProductRep or all(c == 1 for c in self.reps.values()): return None
+        axes = [[(I(rep.size()), [(0,)])] if c == 1 else list(tensor_power_components(rep.size(), c).values())
+                for rep, c in self.reps.items()]
+        offsets = np.cumsum([0] + list(self.reps.values()))
+        ids = np.arange(self.size()).reshape([rep.size() for rep, c in self.reps.items() for _ in range(c)])
+        components = []
+        for choice in itertools.product(*axes):
+            B = LazyKron([Bi for Bi, _ in choice])
+            perms = [ids.transpose(np.concatenate([offset + np.array(p) for offset, p in zip(offsets, axis_perms)]))
+                     .reshape(-1) for axis_perms in itertools.product(*[perms for _, perms in choice])]
+            components.append((B, perms))
+        return components
+
     def __hash__(self):
         assert self.canonical, f"Not canonical {repr(self)}? perm {self.perm}"
         return hash(tuple(self.reps.items()))
@@ -416,6 +504,13 @@ class DirectProduct(ProductRep):
         self.is_permutation = all(rep.is_permutation for rep in self.reps.keys())
         assert all(count == 1 for count in self.reps.values())
 
+    def basis_components(self):
+        return [leaf for rep in self.reps for leaf in rep.basis_components()]
+
+    def invariant_dimension(self, closed_form=False):
+        dims = [rep.invariant_dimension(closed_form) for rep in self.reps]
+        return None if None in dims else product(dims)
+
     def equivariant_basis(self):
         canon_Q = LazyKron([rep.equivariant_basis() for rep, c in self.reps.items()])
         return LazyPerm(self.invperm) @ canon_Q
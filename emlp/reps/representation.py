@@ -1,16 +1,22 @@
+import hashlib
 import numpy as np
+import scipy.linalg
 import jax
 import jax.numpy as jnp
 from jax import jit, device_put, vmap
 import optax
 from sklearn.cluster import KMeans
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from tqdm.auto import tqdm
 from .linear_operator_base import LinearOperator, Lazy
-from .linear_operators import ConcatLazy, I, lazify, densify, LazyJVP
+from .linear_operators import ConcatLazy, I, lazify, densify, LazyJVP, LazyKron, LazyPerm
 import logging
 import matplotlib.pyplot as plt
 from functools import reduce
-from emlp.utils import export, memory
+from emlp.utils import export
+from .basis_store import get_basis_store
+from .basis_cache import default_cache
 import torch
 
 from plum import dispatch
@@ -20,7 +26,7 @@ import emlp.reps
 # TODO and simpler rep = flatten({Scalar:2,Vector:10,...}),
 # Do we even want + operator to implement non canonical orderings?
 
-__all__ = ["V", "Vector", "Scalar"]
+__all__ = ["V", "Vector", "Scalar", "solver_options", "parallel_options"]
 
 
 @export
@@ -36,10 +42,6 @@ class Rep(object):
 
     is_permutation = False
 
-    def __init__(self):
-        self.equivariant_projector = memory.cache(self.equivariant_projector)
-        self.equivariant_basis = memory.cache(self.equivariant_basis)
-
     def rho(self, M):
         """ Group representation of the matrix M of shape (d,d)"""
         raise NotImplementedError
@@ -63,9 +65,9 @@ class Rep(object):
     def __eq__(self, other):
         if type(self) != type(other): return False
         d1 = tuple(
-            [(k, v) for k, v in self.__dict__.items() if (k not in ['_size', 'is_permutation', 'is_orthogonal'])])
+            [(k, v) for k, v in self.__dict__.items() if (k not in ['_size', '_fingerprint', 'is_permutation', 'is_orthogonal'])])
         d2 = tuple(
-            [(k, v) for k, v in other.__dict__.items() if (k not in ['_size', 'is_permutation', 'is_orthogonal'])])
+            [(k, v) for k, v in other.__dict__.items() if (k not in ['_size', '_fingerprint', 'is_permutation', 'is_orthogonal'])])
         return d1 == d2
 
     def __hash__(self):
@@ -76,7 +78,7 @@ class Rep(object):
             if isinstance(state_dict[k], list):
                 state_dict[k] = tuple(state_dict[k])
 
-        d1 = tuple([(k, v) for k, v in state_dict.items() if (k not in ['_size', 'is_permutation', 'is_orthogonal'])])
+        d1 = tuple([(k, v) for k, v in state_dict.items() if (k not in ['_size', '_fingerprint', 'is_permutation', 'is_orthogonal'])])
         return hash((type(self), d1))
 
     def size(self):
@@ -105,17 +107,20 @@ class Rep(object):
         """ A convenience function which returns drho(A) as a dense matrix."""
         return densify(self.drho(A))
 
-    def constraint_matrix(self):
+    def constraint_matrix(self, generators=None):
         """ Constructs the equivariance constrant matrix (lazily) by concatenating
         the constraints (ρ(hᵢ)-I) for i=1,...M and dρ(Aₖ) for k=1,..,D from the generators
-        of the symmetry group. """
+        of the symmetry group, or from another generating set generators=(discrete_generators,
+        lie_algebra) of it such as G.minimal_generators(). """
         n = self.size()
+        discrete_generators, lie_algebra = (self.G.discrete_generators, self.G.lie_algebra) \
+            if generators is None else generators
         constraints = []
-        constraints.extend([lazify(self.rho(h)) - I(n) for h in self.G.discrete_generators])
-        constraints.extend([lazify(self.drho(A)) for A in self.G.lie_algebra])
+        constraints.extend([lazify(self.rho(h)) - I(n) for h in discrete_generators])
+        constraints.extend([lazify(self.drho(A)) for A in lie_algebra])
         return ConcatLazy(constraints) if constraints else lazify(jnp.zeros((1, n)))
 
-    solcache = {}
+    solcache = default_cache  # Shared BasisCache of the solved canonical bases (see basis_cache.py)
 
     def equivariant_basis(self):
         """ Computes the equivariant solution basis for the given representation of size N.
@@ -123,21 +128,32 @@ class Rep(object):
         if self == Scalar: return jnp.ones((1, 1))
         canon_rep, perm = self.canonicalize()
         invperm = np.argsort(perm)
-        if canon_rep not in self.solcache:
-            logging.info(f"{canon_rep} cache miss")
-            logging.info(f"Solving basis for {self}" + (f", for G={self.G}" if hasattr(self, "G") else ""))
-            # if isinstance(group,Trivial): return np.eye(size(rank,group.d))
-            C_lazy = canon_rep.constraint_matrix()
-            if C_lazy.shape[0] * C_lazy.shape[1] > 3e7:  # Too large to use SVD
-                result = krylov_constraint_solve(C_lazy)
-            else:
-                C_dense = C_lazy.to_dense()
-                result = orthogonal_complement(C_dense)
-            self.solcache[canon_rep] = result
-        return self.solcache[canon_rep][invperm]
+        factors = canon_rep.factorize()
+        restriction = canon_rep.restrict_embedding() if factors is None else None
+        if factors is not None:  # Basis of a product group rep assembled from the bases for the factor groups
+            reps, kron_perm = factors
+            Qs = [rep.equivariant_basis() for rep in reps]
+            if any(Qi.shape[-1] == 0 for Qi in Qs): Q = jnp.zeros((canon_rep.size(), 0))
+            else: Q = LazyPerm(kron_perm) @ LazyKron(Qs)
+        elif restriction is not None:  # Basis of an embedded group rep assembled from the embedded group bases
+            rep, embed_perm = restriction
+            Q = rep.equivariant_basis()
+            if Q.shape[-1] == 0: Q = jnp.zeros((canon_rep.size(), 0))
+            else: Q = LazyPerm(np.argsort(embed_perm)) @ lazify(Q)
+        else:
+            Q = self.solcache.get(canon_rep)
+            if Q is None: Q = solve_bases([canon_rep])[canon_rep]
+        if (invperm == np.arange(len(invperm))).all(): return Q
+        return LazyPerm(invperm) @ Q if isinstance(Q, LinearOperator) else Q[invperm]
 
     def equivariant_projector(self):
         """ Computes the (lazy) projection matrix P=QQᵀ that projects to the equivariant basis."""
+        canon_rep, perm = self.canonicalize()
+        restriction = canon_rep.restrict_embedding()
+        if restriction is not None:
+            rep, embed_perm = restriction
+            P = LazyPerm(np.argsort(embed_perm)) @ rep.equivariant_projector() @ LazyPerm(embed_perm)
+            return LazyPerm(np.argsort(perm)) @ P @ LazyPerm(perm)
         Q = self.equivariant_basis()
         Q_lazy = lazify(Q)
         P = Q_lazy @ Q_lazy.H
@@ -146,6 +162,88 @@ class Rep(object):
         # print('Q = ', Q.shape)
         return P
 
+    def basis_components(self):
+        """ The canonical representations whose equivariant bases are needed to assemble
+            the basis of this representation."""
+        if self == Scalar: return []
+        canon_rep = self.canonicalize()[0]
+        factors = canon_rep.factorize()
+        if factors is not None: return [leaf for rep in factors[0] for leaf in rep.basis_components()]
+        restriction = canon_rep.restrict_embedding()
+        if restriction is not None: return restriction[0].basis_components()
+        return [canon_rep]
+
+    def factorize(self):
+        """ For (canonical) representations of a direct product group G₁×G₂ built from its base
+            representation V₁⊗V₂, returns the representations (rep₁,rep₂) of G₁ and G₂ along
+            with the permutation kron_perm such that rep ≅ rep₁⊗rep₂ with ρ(g)=Pρ₁(g₁)⊗ρ₂(g₂)Pᵀ
+            where Pv=v[kron_perm]. The basis is then the (permuted) Kronecker product of the bases
+            for rep₁ and rep₂, and the constraints of the full rep never need to be formed.
+            Returns None for representations that do not factor this way."""
+        return None
+
+    def restrict_embedding(self):
+        """ For (canonical) representations of an Embed group, which acts as G on some of the
+            coordinates and trivially on the rest, returns the equivalent representation of G
+            (the base representation splits into V_G⊕(d-k)V⁰ and tensor products distribute into
+            sums of smaller G tensors) along with the permutation embed_perm such that v[embed_perm]
+            is the corresponding vector of that representation. Returns None otherwise."""
+        return None
+
+    def isotypic_components(self):
+        """ For (canonical) tensor products with repeated factors, the permutations of the identical
+            factors commute with the action of G, so the equivariant subspace splits over their
+            isotypic components (symmetric, antisymmetric and mixed symmetry). Returns a list of
+            (B,perms) with the orthonormal basis B of one copy of each component and the index
+            permutations v[perm] of the tensor that map it to the other copies (see
+            symmetric_group.tensor_power_components). Returns None otherwise."""
+        return None
+
+    def character(self, gs):
+        """ The character χ(g)=tr(ρ(g)) evaluated on a batch of group elements gs (N,d,d). Output (N,)"""
+        return np.array([np.trace(np.asarray(self.rho_dense(g))) for g in gs])
+
+    def invariant_dimension(self, closed_form=False):
+        """ Dimension of the space of invariant vectors, i.e. the number of columns of the
+            equivariant basis, computed from the character without solving the constraints:
+            dim = ∫χ(g)dg over the Haar measure. The count is exact for permutation representations
+            (the number of orbits) and for finite groups that can be enumerated, and for compact
+            Lie groups the integral is evaluated on the maximal torus (Weyl integration formula)
+            with increasing resolution until it converges. Raises NotImplementedError when the
+            group provides no Haar quadrature (e.g. non compact groups).
+            With closed_form=True only the counts that need no quadrature are computed (scalars,
+            permutation representations and the factorized, restricted, sum and product forms
+            built from them), and None is returned otherwise."""
+        if self == Scalar: return 1
+        factors = self.canonicalize()[0].factorize()
+        if factors is not None:
+            dims = [rep.invariant_dimension(closed_form) for rep in factors[0]]
+            return None if None in dims else int(np.prod(dims))
+        restriction = self.canonicalize()[0].restrict_embedding()
+        if restriction is not None: return restriction[0].invariant_dimension(closed_form)
+        n = self.size()
+        if self.is_permutation and len(self.G.lie_algebra) == 0:
+            return int(permutation_orbits([index_permutation(self.rho(h), n) for h in self.G.discrete_generators], n)[0])
+        if closed_form: return None
+        dim = None
+        for resolution in (8, 16, 32, 64, 128):
+            gs, ws = self.G.haar_quadrature(resolution)
+            if len(ws) > 2 ** 18: break
+            dim, prev_dim = np.real(ws @ self.character(gs)), dim
+            if prev_dim is not None and abs(dim - prev_dim) < 1e-3: return int(np.round(dim))
+        raise NotImplementedError(f"Haar integral of the character of {self} did not converge")
+
+    def orbits(self):
+        """ The orbits of the group action on the indices of a permutation representation of a
+            discrete group, on which the equivariant vectors are constant (see orbit_basis).
+            Returns (number of orbits, orbit label (int32) of each index)."""
+        if self == Scalar: return 1, np.zeros(1, dtype=np.int32)
+        if not (self.is_permutation and len(self.G.lie_algebra) == 0):
+            raise NotImplementedError(f"{self} is not a permutation representation of a discrete group")
+        n = self.size()
+        num_orbits, labels = permutation_orbits([index_permutation(self.rho(h), n) for h in self.G.discrete_generators], n)
+        return int(num_orbits), labels.astype(np.int32)
+
     @property
     def concrete(self):
         return hasattr(self, "G") and self.G is not None
@@ -197,7 +295,7 @@ class Rep(object):
 
     def __lt__(self, other):
         """ less than defined to disambiguate ordering multiple different representations.
-            Canonical ordering is determined first by Group, then by size, then by hash"""
+            Canonical ordering is determined first by Group, then by size, then by repr and fingerprint"""
         if other == Scalar: return False
         try:
             if self.G < other.G: return True
@@ -206,7 +304,18 @@ class Rep(object):
             pass
         if self.size() < other.size(): return True
         if self.size() > other.size(): return False
-        return hash(self) < hash(other)  # For sorting purposes only
+        if repr(self) != repr(other): return repr(self) < repr(other)  # For sorting purposes only
+        return self.fingerprint() < other.fingerprint()
+
+    def fingerprint(self):
+        """ Deterministic (across processes) SHA-256 fingerprint of the representation, computed
+            from a canonical serialization of the representation tree and the group generators.
+            Used as the key for persistent caches and memoized on the instance."""
+        if getattr(self, '_fingerprint', None) is None:
+            state = {k: v for k, v in self.__dict__.items() if not k.startswith('_') and
+                     k not in ['is_permutation', 'is_orthogonal']}
+            self._fingerprint = hashlib.sha256(f"{type(self).__name__}{serialize(state)}".encode()).hexdigest()
+        return self._fingerprint
 
     def __mod__(self, other):  # Wreath product
         """ Wreath product of representations (Not yet implemented)"""
@@ -263,6 +372,9 @@ class ScalarRep(Rep):
     def rho(self, M):
         return jnp.eye(1)
 
+    def character(self, gs):
+        return np.ones(len(gs))
+
     def drho(self, M):
         return 0 * jnp.eye(1)
 
@@ -272,6 +384,9 @@ class ScalarRep(Rep):
     def __eq__(self, other):
         return isinstance(other, ScalarRep)
 
+    def fingerprint(self):
+        return hashlib.sha256(b"ScalarRep").hexdigest()
+
     def __mul__(self, other):
         if isinstance(other, int): return super().__mul__(other)
         return other
@@ -304,6 +419,19 @@ class Base(Rep):
         if hasattr(self, 'G') and isinstance(A, dict): A = A[self.G]
         return A
 
+    def character(self, gs):
+        return np.trace(np.asarray(gs), axis1=-2, axis2=-1)
+
+    def factorize(self):
+        if not hasattr(self.G, 'factors'): return None
+        return tuple(self.__class__(G) for G in self.G.factors), np.arange(self.size())
+
+    def restrict_embedding(self):
+        if not hasattr(self.G, 'embedded'): return None
+        indices = self.G.embedded_indices
+        rest = np.setdiff1d(np.arange(self.size()), indices)
+        return self.__class__(self.G.embedded) + len(rest), np.concatenate([indices, rest])
+
     def size(self):
         assert self.G is not None, f"must know G to find size for rep={self}"
         return self.G.d
@@ -346,6 +474,21 @@ class Dual(Rep):
     def drho(self, A):
         return -self.rep.drho(A).T
 
+    def character(self, gs):
+        return self.rep.character(np.linalg.inv(np.asarray(gs)))
+
+    def factorize(self):
+        factors = self.rep.factorize()
+        if factors is None: return None
+        reps, kron_perm = factors
+        return tuple(rep.T for rep in reps), kron_perm
+
+    def restrict_embedding(self):
+        restriction = self.rep.restrict_embedding()
+        if restriction is None: return None
+        rep, embed_perm = restriction
+        return rep.T, embed_perm
+
     def __str__(self):
         return str(self.rep) + "*"
 
@@ -381,6 +524,178 @@ def T(p, q=0, G=None):
     return (V ** p * V.T ** q)(G)
 
 
+#: Keyword arguments passed to krylov_constraint_solve by Rep.equivariant_basis
+#: e.g. solver_options['method'] = 'lobpcg' to use the LOBPCG backend. With minimal_generators
+#: the constraints are formed from G.minimal_generators() rather than all of the generators,
+#: and verify_generators checks the resulting basis against the constraints of the full set.
+#: With sequential the null space is refined one generator at a time (sequential_constraint_solve).
+#: With isotypic tensor products are solved one symmetry type of their repeated factors at a time
+#: (isotypic_constraint_solve). Large Krylov solves are given the rank when it has a closed form
+#: (Rep.invariant_dimension), with character_rank it is also integrated from the character otherwise.
+solver_options = {'method': 'sgd', 'minimal_generators': False, 'verify_generators': False, 'sequential': False,
+                  'isotypic': False, 'character_rank': False}
+
+#: Executors (concurrent.futures) used by solve_bases to solve independent bases concurrently.
+#: Disabled by default, e.g. parallel_options['threads'] = ThreadPoolExecutor(8). Solves with an
+#: estimated cost above process_cutoff are sent to parallel_options['processes'] if it is set
+#: (use a 'spawn' multiprocessing context for it, JAX is not fork safe).
+parallel_options = {'threads': None, 'processes': None, 'process_cutoff': 1e10}
+
+
+def serialize(value):
+    """ Canonical string serialization of (nested) rep state for fingerprinting."""
+    if hasattr(value, 'fingerprint'): return value.fingerprint()
+    if isinstance(value, dict):  # sorted so that the insertion order of the fields does not matter
+        return '{' + ','.join(sorted(f"{serialize(k)}:{serialize(v)}" for k, v in value.items())) + '}'
+    if isinstance(value, (list, tuple)): return '(' + ','.join(serialize(v) for v in value) + ')'
+    if isinstance(value, (np.ndarray, jax.Array)):
+        value = np.ascontiguousarray(np.asarray(value))
+        return hashlib.sha256(str((value.shape, value.dtype)).encode() + value.tobytes()).hexdigest()
+    if callable(value): return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}"
+    return repr(value)
+
+
+def solve_cost(rep):
+    """ Rough estimate of the number of flops needed to solve for the basis of rep."""
+    n = rep.size()
+    if rep.is_permutation and len(rep.G.lie_algebra) == 0: return n * len(rep.G.discrete_generators)
+    return (len(rep.G.discrete_generators) + len(rep.G.lie_algebra)) * n ** 2 + n ** 3
+
+
+def solve_equivariant_basis(rep, options=None):
+    """ Solves for the equivariant basis Q (N,r) of the canonical representation rep
+        without consulting any of the caches."""
+    # if isinstance(group,Trivial): return np.eye(size(rank,group.d))
+    if rep.is_permutation and len(rep.G.lie_algebra) == 0:  # Exact solution from the orbits, no constraint solve
+        return orbit_basis(rep)
+    options = dict(solver_options if options is None else options)
+    Q = subgroup_constraint_solve(rep, **{k: v for k, v in options.items() if k in ['method', 'tol']})
+    if Q is not None: return Q
+    minimal = options.pop('minimal_generators', False)
+    verify = options.pop('verify_generators', False)
+    sequential = options.pop('sequential', False)
+    character_rank = options.pop('character_rank', False)
+    components = rep.isotypic_components() if options.pop('isotypic', False) else None
+    C_lazy = rep.constraint_matrix(rep.G.minimal_generators() if minimal else None)
+    if components is not None:
+        Q = isotypic_constraint_solve(C_lazy, components, **options)
+    elif sequential:
+        Q = sequential_constraint_solve(C_lazy, **options)
+    elif C_lazy.shape[1] ** 2 > 3e7:  # Too large to form the Gram matrix
+        store = get_basis_store()
+        checkpoint = store.checkpoint(rep) if store is not None else None
+        try:  # without a closed form the rank needs a Haar quadrature of the character, done only when asked for
+            rank = rep.invariant_dimension(closed_form=not character_rank)
+        except NotImplementedError:
+            rank = None
+        Q = krylov_constraint_solve(C_lazy, rank=rank, checkpoint=checkpoint, **options)
+    else:
+        Q = gram_constraint_solve(C_lazy)
+    if minimal and verify:
+        residual = jnp.abs(rep.constraint_matrix() @ Q).max() if Q.shape[-1] else 0
+        if residual > 1e-3:
+            raise ConvergenceError(f"Basis for {rep} solved with the minimal generators violates "
+                                   f"the constraints of the full generating set by {residual:.2e}")
+    return Q
+
+
+def cached_basis(rep):
+    """ The basis of rep if it has already been solved for (in memory or in the basis store), else None."""
+    canon_rep, perm = rep.canonicalize()
+    Q = Rep.solcache.get(canon_rep)
+    store = get_basis_store()
+    if Q is None and store is not None: Q = store.load(canon_rep)
+    return None if Q is None else Q[np.argsort(perm)]
+
+
+def subgroup_constraint_solve(rep, **kwargs):
+    """ Reuses a cached basis Q_H of the same tensor type for a subgroup H of rep.G (see
+        Group.subgroups), solving only the constraints of the remaining generators of G
+        restricted to span(Q_H). Returns None if no such basis has been solved for yet."""
+    for H, generators in rep.G.subgroups():
+        try:
+            Q_H = cached_basis(rep(H))
+        except (NotImplementedError, TypeError):
+            continue
+        if Q_H is None: continue
+        logging.info(f"Solving for {rep} of {rep.G} inside the cached basis of subgroup {H}")
+        Q_H = device_put(np.asarray(Q_H))
+        if not Q_H.shape[-1] or not sum(len(gens) for gens in generators): return Q_H
+        return Q_H @ sequential_constraint_solve(lazify(rep.constraint_matrix(generators)) @ lazify(Q_H), **kwargs)
+    return None
+
+
+def solve_bases(reps):
+    """ Fills Rep.solcache with the bases of the canonical representations reps, loading
+        them from the basis store when possible. The remaining solves are independent
+        and are run concurrently on the executors in parallel_options if configured.
+        Returns a dictionary with the bases for reps."""
+    bases = {}
+    missing = []
+    for rep in dict.fromkeys(reps):  # deduplicate while preserving the order
+        Q = Rep.solcache.get(rep)
+        if Q is None:
+            store = get_basis_store()
+            Q = store.load(rep) if store is not None else None
+            if Q is not None: Rep.solcache[rep] = Q
+        if Q is None: missing.append(rep)
+        else: bases[rep] = Q
+    if not missing: return bases
+    logging.info(f"Solving bases for {', '.join(str(rep) for rep in missing)}")
+
+    def submit(rep):
+        if parallel_options['processes'] is not None and solve_cost(rep) > parallel_options['process_cutoff']:
+            return parallel_options['processes'].submit(solve_equivariant_basis, rep, dict(solver_options))
+        if parallel_options['threads'] is not None:
+            return parallel_options['threads'].submit(solve_equivariant_basis, rep)
+        return None
+
+    # Submit the most expensive solves first so that they do not end up last in the queue
+    futures = {rep: submit(rep) for rep in sorted(missing, key=solve_cost, reverse=True)}
+    for rep in missing:
+        Q = solve_equivariant_basis(rep) if futures[rep] is None else futures[rep].result()
+        store = get_basis_store()
+        if store is not None: store.save(rep, Q)
+        Rep.solcache[rep] = bases[rep] = Q
+    return bases
+
+
+def index_permutation(M, n):
+    """ Given a (lazy) permutation matrix M of size (n,n), returns the integer array perm
+        such that M@v = v[perm]. Indices are encoded in two float32 digits to remain exact."""
+    ids = np.arange(n)
+    digits = np.stack([ids // 4096, ids % 4096], axis=-1).astype(np.float32)
+    permuted = np.rint(np.asarray(lazify(M) @ digits)).astype(np.int64)
+    return permuted[:, 0] * 4096 + permuted[:, 1]
+
+
+def permutation_orbits(perms, n):
+    """ Computes the orbits of the group generated by the permutations perms acting on
+        the indices 0,...,n-1, as the connected components of the graph with edges i~perm[i]
+        (union-find over the generators). Returns (number of orbits, orbit label of each index)."""
+    if not len(perms): return n, np.arange(n)
+    rows = np.concatenate([np.arange(n)] * len(perms))
+    cols = np.concatenate(perms)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n, n))
+    return connected_components(graph, directed=True, connection='weak')
+
+
+def orbit_basis(rep):
+    """ Exact equivariant basis for a permutation representation of a discrete group.
+        The invariant vectors are exactly those that are constant on each orbit of the
+        group action on the indices, so the normalized orbit indicators form an orthonormal
+        basis. The orbits are found in O(n·#generators) time and memory, the returned Q is
+        dense (n·r floats) although it has a single nonzero per row, since the basis caches and
+        the store hold dense bases (see Rep.orbits for the labels alone). Output [Q (N,r)]"""
+    n = rep.size()
+    perms = [index_permutation(rep.rho(h), n) for h in rep.G.discrete_generators]
+    num_orbits, labels = permutation_orbits(perms, n)
+    orbit_sizes = np.bincount(labels, minlength=num_orbits)
+    Q = np.zeros((n, num_orbits), dtype=np.float32)
+    Q[np.arange(n), labels] = 1 / np.sqrt(orbit_sizes[labels])
+    return Q
+
+
 def orthogonal_complement(proj):
     """ Computes the orthogonal complement to a given matrix proj"""
     U, S, VH = jnp.linalg.svd(proj, full_matrices=True)
@@ -388,48 +703,150 @@ def orthogonal_complement(proj):
     return VH[rank:].conj().T
 
 
-def krylov_constraint_solve(C, tol=1e-5):
+def gram_constraint_solve(C, tol=1e-5, chunk_size=1024):
+    """ Computes the solution basis Q for the linear constraint CQ=0 and QᵀQ=I from the
+        (N,N) Gram matrix CᴴC = ΣᵢCᵢᴴCᵢ accumulated in float64 one constraint block Cᵢ
+        (generator) at a time. Each block is densified by applying it to chunks of the
+        identity, so the peak memory does not grow with the number of generators. """
+    n = C.shape[-1]
+    blocks = C.Ms if isinstance(C, ConcatLazy) else [C]
+    gram = np.zeros((n, n), dtype=np.float64)
+    for M in blocks:
+        M_dense = np.concatenate([np.asarray(M @ jnp.eye(n, min(chunk_size, n - j), -j))
+                                  for j in range(0, n, chunk_size)], axis=-1)
+        if np.iscomplexobj(M_dense): gram = gram.astype(np.complex128)
+        M_dense = M_dense.astype(gram.dtype)
+        gram += M_dense.conj().T @ M_dense
+    eigs, V = np.linalg.eigh(gram)
+    rank = (eigs < tol ** 2).sum()  # eigenvalues of CᴴC are the squared singular values of C
+    return device_put(V[:, :rank].astype(np.complex64 if np.iscomplexobj(V) else np.float32))
+
+
+def sequential_constraint_solve(C, tol=1e-5, **kwargs):
+    """ Computes the solution basis Q for the linear constraint CQ=0 and QᵀQ=I by refining the
+        null space one constraint block Cᵢ (generator) at a time: Q₁ spans the null space of C₁,
+        and each subsequent Qᵢ = Qᵢ₋₁Rᵢ where Rᵢ spans the null space of the restricted
+        (rᵢ₋₁ dimensional) problem CᵢQᵢ₋₁R=0. Each subproblem is solved with the dense Gram
+        solver when small enough and with krylov_constraint_solve (given kwargs) otherwise,
+        so once a generator has cut down the dimension the remaining problems are tiny."""
+    blocks = C.Ms if isinstance(C, ConcatLazy) else [C]
+    Q = None
+    for M in blocks:
+        C_sub = lazify(M) if Q is None else lazify(M) @ lazify(Q)
+        if C_sub.shape[-1] ** 2 > 3e7: R = krylov_constraint_solve(C_sub, tol, **kwargs)
+        else: R = gram_constraint_solve(C_sub, tol)
+        Q = R if Q is None else Q @ R
+        logging.debug(f"Sequential constraint solve: restricted to {Q.shape[-1]} dimensions")
+        if not Q.shape[-1]: break
+    return Q
+
+
+def isotypic_constraint_solve(C, components, tol=1e-5, **kwargs):
+    """ Computes the solution basis Q for the linear constraint CQ=0 and QᵀQ=I one isotypic component
+        (B,perms) at a time (see Rep.isotypic_components). The solutions R of the restricted problem
+        CBR=0 are only dim(B) dimensional, and the solutions in the other copies of the component are
+        the permutations (BR)[perm]. The restricted problems are solved on the lazy operator CB, with
+        the dense Gram solver (which applies it to chunks of the identity) when small enough and with
+        krylov_constraint_solve (given kwargs) otherwise, so neither B nor CB is ever densified."""
+    blocks = C.Ms if isinstance(C, ConcatLazy) else [C]
+    Qs = []
+    for B, perms in components:
+        C_sub = ConcatLazy([lazify(M) @ lazify(B) for M in blocks])
+        if C_sub.shape[-1] ** 2 > 3e7: R = krylov_constraint_solve(C_sub, tol, **kwargs)
+        else: R = gram_constraint_solve(C_sub, tol)
+        logging.debug(f"Isotypic constraint solve: {R.shape[-1]} of {C_sub.shape[-1]} dimensions, {len(perms)} copies")
+        if not R.shape[-1]: continue
+        W = B @ R
+        Qs.append(jnp.linalg.qr(jnp.concatenate([W[perm] for perm in perms], axis=-1))[0])
+    return jnp.concatenate(Qs, axis=-1) if Qs else jnp.zeros((C.shape[-1], 0))
+
+
+def krylov_constraint_solve(C, tol=1e-5, method='sgd', rank=None, checkpoint=None, **kwargs):
     """ Computes the solution basis Q for the linear constraint CQ=0  and QᵀQ=I
-        up to specified tolerance with C expressed as a LinearOperator. """
-    r = 5
-    if C.shape[0] * r * 2 > 2e9: raise Exception(f"Solns for contraints {C.shape} too large to fit in memory")
-    found_rank = 5
-    while found_rank == r:
+        up to specified tolerance with C expressed as a LinearOperator.
+        The iterative backend is selected with method: 'sgd' (gradient descent with momentum),
+        'sgd_device' (the same, run in a single on device loop) or 'lobpcg' (block preconditioned
+        eigensolver on CᵀC). Additional kwargs are passed on to the backend. If the dimension of
+        the solution space is known in advance (rank, see Rep.invariant_dimension) the solver
+        allocates rank+1 columns, the extra column certifying that no solutions are missing,
+        instead of doubling the number of columns until the space is covered. If a SolveCheckpoint
+        is given, the solver state is checkpointed periodically and the solve resumes from the
+        last checkpoint. """
+    solve_upto_r = {'sgd': krylov_constraint_solve_upto_r, 'sgd_device': device_krylov_constraint_solve_upto_r,
+                    'lobpcg': lobpcg_constraint_solve_upto_r}[method]
+    r = 10 if rank is None else rank + 1
+    if C.shape[0] * r > 2e9: raise Exception(f"Solns for contraints {C.shape} too large to fit in memory")
+    Q = None
+    resume = checkpoint.load() if checkpoint is not None else None
+    if resume is not None and str(resume['method']) == method:
+        logging.info(f"Resuming {method} constraint solve at rank {int(resume['r'])} from {checkpoint.path}")
+        r = int(resume['r'])
+        Q = device_put(resume['Q0']) if resume['Q0'].shape[-1] else None
+    else:
+        resume = None
+    while True:
+        if checkpoint is not None: kwargs.update(checkpoint=checkpoint, resume=resume)
+        # Converged solutions from the previous round are kept fixed, only the new directions are solved for
+        Q = solve_upto_r(C, r, tol, Q0=Q, **kwargs)
+        resume = None
+        if Q.shape[-1] < r: break
         r *= 2  # Iterative doubling of rank until large enough to include the full solution space
         if C.shape[0] * r > 2e9:
-            logging.error(f"Hit memory limits, switching to sample equivariant subspace of size {found_rank}")
+            logging.error(f"Hit memory limits, switching to sample equivariant subspace of size {Q.shape[-1]}")
             break
-        Q = krylov_constraint_solve_upto_r(C, r, tol)
-        found_rank = Q.shape[-1]
+    if rank is not None and Q.shape[-1] != rank:
+        logging.warning(f"Found {Q.shape[-1]} solutions to the constraints but the invariant dimension is {rank}")
+    if checkpoint is not None: checkpoint.clear()
     return Q
 
 
-def krylov_constraint_solve_upto_r(C, r, tol=1e-5, lr=1e-2):  # ,W0=None):
+def checkpoint_state(method, r, Q0, **state):
+    """ Solver state to be saved in a SolveCheckpoint."""
+    Q0 = np.zeros((0, 0)) if Q0 is None else np.asarray(Q0)
+    return dict(method=method, r=r, Q0=Q0, **state)
+
+
+def krylov_constraint_solve_upto_r(C, r, tol=1e-5, lr=1e-2, Q0=None, checkpoint=None, resume=None):
     """ Iterative routine to compute the solution basis to the constraint CQ=0 and QᵀQ=I
         up to the rank r, with given tolerance. Uses gradient descent (+ momentum) on the
-        objective |CQ|^2, which provably converges at an exponential rate."""
-    W = np.random.randn(C.shape[-1], r) / np.sqrt(C.shape[-1])  # if W0 is None else W0
+        objective |CQ|^2, which provably converges at an exponential rate.
+        If given, the columns of the already converged (orthonormal) solutions Q0 are kept
+        and only the remaining r-Q0.shape[-1] directions orthogonal to them are optimized.
+        The state is periodically saved to checkpoint and restored from resume if given."""
+    k = 0 if Q0 is None else Q0.shape[-1]
+    W = np.random.randn(C.shape[-1], r - k) / np.sqrt(C.shape[-1])
+    if resume is not None: W, lr = resume['W'], float(resume['lr'])
     W = device_put(W)
     opt_init, opt_update = optax.sgd(lr, .9)
     opt_state = opt_init(W)  # init stats
+    if resume is not None: opt_state = jax.tree_util.tree_unflatten(
+        jax.tree_util.tree_structure(opt_state), [device_put(resume[f'opt_{j}']) for j in range(int(resume['n_opt']))])
+    start = 0 if resume is None else int(resume['step'])
+
+    def deflate(W):
+        return W if Q0 is None else W - Q0 @ (Q0.T @ W)
 
     def loss(W):
-        return (jnp.absolute(C @ W) ** 2).sum() / 2  # added absolute for complex support
+        return (jnp.absolute(C @ deflate(W)) ** 2).sum() / 2  # added absolute for complex support
 
     loss_and_grad = jit(jax.value_and_grad(loss))
     # setup progress bar
     pbar = tqdm(total=100, desc=f'Krylov Solving for Equivariant Subspace r<={r}',
                 bar_format="{l_bar}{bar}| {n:.3g}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]")
     prog_val = 0
-    lstart, _ = loss_and_grad(W)
+    lstart = float(loss(W) if resume is None else resume['lstart'])
 
-    for i in range(20000):
+    for i in range(start, 20000):
 
         lossval, grad = loss_and_grad(W)
         updates, opt_state = opt_update(grad, opt_state, W)
         W = optax.apply_updates(W, updates)
+        if checkpoint is not None and checkpoint.due():
+            opt_leaves = jax.tree_util.tree_leaves(opt_state)
+            checkpoint.save(**checkpoint_state('sgd', r, Q0, W=W, lr=lr, step=i + 1, lstart=lstart,
+                                               n_opt=len(opt_leaves), **{f'opt_{j}': v for j, v in enumerate(opt_leaves)}))
         # update progress bar
-        progress = max(100 * np.log(lossval / lstart) / np.log(tol ** 2 / lstart) - prog_val, 0)
+        progress = float(max(100 * np.log(lossval / lstart) / np.log(tol ** 2 / lstart) - prog_val, 0))
         progress = min(100 - prog_val, progress)
         if progress > 0:
             prog_val += progress
@@ -441,25 +858,190 @@ def krylov_constraint_solve_upto_r(C, r, tol=1e-5, lr=1e-2):  # ,W0=None):
         if lossval > 2e3 and i > 100:  # Solve diverged due to too high learning rate
             logging.warning(f"Constraint solving diverged, trying lower learning rate {lr / 3:.2e}")
             if lr < 1e-4: raise ConvergenceError(f"Failed to converge even with smaller learning rate {lr:.2e}")
-            return krylov_constraint_solve_upto_r(C, r, tol, lr=lr / 3)
+            return krylov_constraint_solve_upto_r(C, r, tol, lr=lr / 3, Q0=Q0, checkpoint=checkpoint)
     else:
         raise ConvergenceError("Failed to converge.")
-    # Orthogonalize solution at the end
-    U, S, VT = np.linalg.svd(np.array(W), full_matrices=False)
-    # Would like to do economy SVD here (to not have the unecessary O(n^2) memory cost) 
-    # but this is not supported in numpy (or Jax) unfortunately.
+    return orthogonalize_solution(C, deflate(W), r, tol, Q0)
+
+
+def device_krylov_constraint_solve_upto_r(C, r, tol=1e-5, lr=1e-2, Q0=None, maxiter=20000, report_every=200,
+                                          checkpoint=None, resume=None):
+    """ Same as krylov_constraint_solve_upto_r, but the optimization runs entirely on device
+        inside a jax.lax.while_loop with the convergence and divergence checks evaluated on
+        device. Progress is sent to the host only every report_every steps (through a
+        jax.debug.callback), avoiding a device sync and Python dispatch on every step.
+        Checkpoints (if enabled) are written from the same host callback."""
+    k = 0 if Q0 is None else Q0.shape[-1]
+    W = np.random.randn(C.shape[-1], r - k) / np.sqrt(C.shape[-1])
+    if resume is not None: W, lr = resume['W'], float(resume['lr'])
+    W = device_put(W)
+    opt_init, opt_update = optax.sgd(lr, .9)
+    opt_state = opt_init(W)
+    if resume is not None: opt_state = jax.tree_util.tree_unflatten(
+        jax.tree_util.tree_structure(opt_state), [device_put(resume[f'opt_{j}']) for j in range(int(resume['n_opt']))])
+    start = 0 if resume is None else int(resume['step'])
+
+    def deflate(W):
+        return W if Q0 is None else W - Q0 @ (Q0.T @ W)
+
+    def loss(W):
+        return (jnp.absolute(C @ deflate(W)) ** 2).sum() / 2  # added absolute for complex support
+
+    pbar = tqdm(total=100, desc=f'Krylov Solving for Equivariant Subspace r<={r}',
+                bar_format="{l_bar}{bar}| {n:.3g}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]")
+    lstart = float(loss(W) if resume is None else resume['lstart'])
+
+    def report(i, lossval, *state):
+        progress = float(100 * np.log(lossval / lstart) / np.log(tol ** 2 / lstart))
+        pbar.update(min(max(progress - pbar.n, 0), 100 - pbar.n))
+        pbar.set_postfix(step=int(i), loss=f"{float(lossval):.2e}")
+        if checkpoint is not None and checkpoint.due():
+            W, opt_leaves = state[0], jax.tree_util.tree_leaves(state[1])
+            checkpoint.save(**checkpoint_state('sgd_device', r, Q0, W=W, lr=lr, step=i, lstart=lstart,
+                                               n_opt=len(opt_leaves), **{f'opt_{j}': v for j, v in enumerate(opt_leaves)}))
+
+    def diverged(i, lossval):
+        return (lossval > 2e3) & (i > 100)
+
+    def cond(state):
+        i, W, opt_state, lossval = state
+        return (i < maxiter) & (jnp.sqrt(lossval) >= tol) & ~diverged(i, lossval)
+
+    def body(state):
+        i, W, opt_state, _ = state
+        # The state at step i is only sent to the host if it is needed for a checkpoint
+        host_state = (W, opt_state) if checkpoint is not None else ()
+        lossval, grad = jax.value_and_grad(loss)(W)
+        updates, opt_state = opt_update(grad, opt_state, W)
+        W = optax.apply_updates(W, updates)
+        jax.lax.cond(i % report_every == 0, lambda: jax.debug.callback(report, i, lossval, *host_state),
+                     lambda: None)
+        return i + 1, W, opt_state, lossval
+
+    @jit
+    def run(W, opt_state):
+        return jax.lax.while_loop(cond, body, (start, W, opt_state, jnp.asarray(jnp.inf, dtype=W.dtype)))
+
+    i, W, _, lossval = run(W, opt_state)
+    pbar.close()
+    if diverged(i, lossval):  # Solve diverged due to too high learning rate
+        logging.warning(f"Constraint solving diverged, trying lower learning rate {lr / 3:.2e}")
+        if lr < 1e-4: raise ConvergenceError(f"Failed to converge even with smaller learning rate {lr:.2e}")
+        return device_krylov_constraint_solve_upto_r(C, r, tol, lr / 3, Q0, maxiter, report_every, checkpoint)
+    if jnp.sqrt(lossval) >= tol: raise ConvergenceError("Failed to converge.")
+    return orthogonalize_solution(C, deflate(W), r, tol, Q0)
+
+
+def orthogonalize_solution(C, W, r, tol, Q0=None):
+    """ Orthonormalizes the converged solution W (orthogonal to Q0) and appends it to Q0."""
+    k = 0 if Q0 is None else Q0.shape[-1]
+    # Orthogonalize solution at the end with a thin rank revealing QR (avoids the O(n^2) memory of a full SVD)
+    Qw, R, _ = scipy.linalg.qr(np.array(W), mode='economic', pivoting=True)
+    S = np.abs(np.diag(R))
     rank = (S > 10 * tol).sum()
-    Q = device_put(U[:, :rank])
+    Q = Qw[:, :rank] if Q0 is None else np.concatenate([np.asarray(Q0), Qw[:, :rank]], axis=-1)
+    Q = device_put(Q)
     # final_L
-    final_L = loss_and_grad(Q)[0]
+    final_L = (jnp.absolute(C @ Q) ** 2).sum() / 2
     if final_L > tol: logging.warning(f"Normalized basis has too high error {final_L:.2e} for tol {tol:.2e}")
-    scutoff = (S[rank] if r > rank else 0)
+    scutoff = (S[rank] if r - k > rank else 0)
     assert rank == 0 or scutoff < S[rank - 1] / 100, f"Singular value gap too small: {S[rank - 1]:.2e} \
         above cutoff {scutoff:.2e} below cutoff. Final L {final_L:.2e}, earlier {S[rank - 5:rank]}"
     # logging.debug(f"found Rank {r}, above cutoff {S[rank-1]:.3e} after {S[rank] if r>rank else np.inf:.3e}. Loss {final_L:.1e}")
     return Q
 
 
+def lobpcg_constraint_solve_upto_r(C, r, tol=1e-5, preconditioner=None, maxiter=5000, callback=None, Q0=None,
+                                   checkpoint=None, resume=None):
+    """ Iterative routine to compute the solution basis to the constraint CQ=0 and QᵀQ=I
+        up to the rank r using a locally optimal block preconditioned conjugate gradient
+        (LOBPCG) eigensolver for the smallest eigenvectors of CᴴC. Only requires products
+        with C (and through autodiff, Cᴴ). The Rayleigh-Ritz step is performed in float64
+        on the host over the span of the current block, the (preconditioned) residuals and
+        the previous search directions.
+
+        Args:
+            C (LinearOperator): constraint matrix of shape (M,N)
+            r (int): block size (maximum rank of the solution)
+            tol (float): tolerance on the residual |Cq| of the solution vectors
+            preconditioner (LinearOperator or array, optional): approximate inverse of CᴴC
+                applied to the residual block
+            maxiter (int): maximum number of iterations
+            callback (callable, optional): called as callback(i, residuals) with the residual
+                norms |Cxᵢ| of the current block at every iteration
+            Q0 (N,k), optional: already converged orthonormal solutions which are kept fixed,
+                only the remaining r-k directions orthogonal to them are solved for
+            checkpoint (SolveCheckpoint, optional): where to periodically save the solver state
+            resume (dict, optional): solver state of a checkpoint to resume from
+
+        Returns:
+            Q (N,rank): orthonormal solution basis, rank<=r """
+    n = C.shape[-1]
+    Q0_in, r_total = Q0, r
+    Q0 = np.zeros((n, 0)) if Q0 is None else np.asarray(Q0, dtype=np.float64)
+    r = min(r, n) - Q0.shape[-1]  # block size
+
+    def deflate(V):
+        return V - Q0 @ (Q0.T @ V)
+
+    apply_C = jit(lambda V: C @ V)
+    gram_matmat = jit(jax.grad(lambda V: (jnp.absolute(C @ V) ** 2).sum() / 2))  # Re(CᴴC V)
+    X = np.linalg.qr(deflate(np.random.randn(n, r)))[0]
+    P = np.zeros((n, 0))
+    start = 0
+    if resume is not None:
+        X, P, eigs, start = resume['X'], resume['P'], resume['eigs'], int(resume['step'])
+        prev_eigs = eigs
+    pbar = tqdm(total=maxiter, desc=f'LOBPCG Solving for Equivariant Subspace r<={r}')
+    for i in range(start, maxiter):
+        if i > 0 and checkpoint is not None and checkpoint.due():
+            checkpoint.save(**checkpoint_state('lobpcg', r_total, Q0_in, X=X, P=P, eigs=eigs, step=i))
+        W = np.asarray(gram_matmat(jnp.asarray(X, dtype=jnp.float32)), dtype=np.float64)
+        if i > 0:
+            W -= X * eigs[None, :]  # residuals of the Ritz pairs (CᴴC - λ)x
+            if preconditioner is not None: W = np.asarray(preconditioner @ W, dtype=np.float64)
+        # Rayleigh-Ritz over span[X,W,P], C is applied to a fixed width block to avoid recompilation
+        S = _orthonormal_extension(X, [deflate(W), deflate(P)])
+        S_padded = np.zeros((n, 3 * r), dtype=np.float32)
+        S_padded[:, :S.shape[-1]] = S
+        CS = np.asarray(apply_C(jnp.asarray(S_padded)))[:, :S.shape[-1]].astype(np.complex128)
+        all_eigs, Y = np.linalg.eigh((CS.conj().T @ CS).real)
+        X_new = S @ Y[:, :r]
+        P = X_new - X @ (X.T @ X_new)
+        X, eigs = X_new, np.maximum(all_eigs[:r], 0)
+        residuals = np.sqrt(eigs)
+        rank = (residuals < tol).sum()
+        if callback is not None: callback(i, residuals)
+        pbar.update(1)
+        pbar.set_postfix(rank=rank, gap=residuals[rank] if rank < r else 0)
+        if rank == r: break
+        # The smallest nonzero Ritz value must also have converged so that no solutions are missed
+        if i > 10 and prev_eigs[rank] - eigs[rank] < 1e-3 * eigs[rank]: break
+        prev_eigs = eigs
+    else:
+        pbar.close()
+        raise ConvergenceError(f"LOBPCG failed to converge in {maxiter} iterations, residuals {residuals}")
+    pbar.close()
+    logging.debug(f"LOBPCG converged in {i + 1} iterations to rank {rank} with gap {residuals[rank] if rank < r else 0:.2e}")
+    assert rank == r or residuals[rank] > 10 * tol, f"Singular value gap too small: {residuals[rank]:.2e} above cutoff"
+    return device_put(np.concatenate([Q0, X[:, :rank]], axis=-1).astype(np.float32))
+
+
+def _orthonormal_extension(X, blocks, eps=1e-8):
+    """ Orthonormal basis for span[X,*blocks] with X (assumed orthonormal) as its first columns."""
+    S = [X]
+    for B in blocks:
+        if not B.shape[-1]: continue
+        B = B - X @ (X.T @ B)
+        norms = np.linalg.norm(B, axis=0)
+        B = B[:, norms > eps * max(norms.max(), 1)] / norms[norms > eps * max(norms.max(), 1)]
+        S.append(B)
+    extra = np.concatenate(S[1:], axis=-1) if len(S) > 1 else np.zeros((X.shape[0], 0))
+    extra = extra - X @ (X.T @ extra)  # reorthogonalize against X
+    U, sigma, _ = np.linalg.svd(extra, full_matrices=False)
+    return np.concatenate([X, U[:, sigma > eps]], axis=-1)
+
+
 class ConvergenceError(Exception): pass
 
 
@@ -0,0 +1,179 @@
+import itertools
+import math
+from collections import defaultdict
+from functools import lru_cache as cache
+import numpy as np
+from .linear_operators import LazyOrbitBasis
+
+
+def partitions(k, max_part=None):
+    """ The partitions λ of k (labelling the irreducible representations of Sₖ) in decreasing lexicographic order."""
+    max_part = k if max_part is None else max_part
+    if k == 0: return [()]
+    return [(first,) + rest for first in range(min(k, max_part), 0, -1) for rest in partitions(k - first, first)]
+
+
+@cache(maxsize=None)
+def sk_character(partition, cycle_type):
+    """ Character χ_λ(σ) of the irreducible representation λ of Sₖ at a permutation with the given cycle
+        type, computed with the Murnaghan–Nakayama rule (removing a border strip of length r from λ
+        moves a bead r positions down on the β-set of λ, with sign given by the beads jumped over)."""
+    if not cycle_type: return 1
+    r, rest = cycle_type[0], cycle_type[1:]
+    beta = [part + len(partition) - 1 - i for i, part in enumerate(partition)]
+    total = 0
+    for b in beta:
+        if b - r < 0 or b - r in beta: continue
+        sign = (-1) ** sum(b - r < c < b for c in beta)
+        new_beta = sorted([c for c in beta if c != b] + [b - r], reverse=True)
+        new_partition = tuple(c - (len(new_beta) - 1 - i) for i, c in enumerate(new_beta))
+        total += sign * sk_character(tuple(part for part in new_partition if part > 0), rest)
+    return total
+
+
+def cycle_type(sigma):
+    """ The cycle lengths of the permutation sigma in decreasing order."""
+    seen, lengths = set(), []
+    for i in range(len(sigma)):
+        j, length = i, 0
+        while j not in seen:
+            seen.add(j)
+            j, length = sigma[j], length + 1
+        if length: lengths.append(length)
+    return tuple(sorted(lengths, reverse=True))
+
+
+def standard_tableaux(partition):
+    """ The standard Young tableaux of shape λ (rows of entries 0,..,k-1 increasing along rows and columns)."""
+    k = sum(partition)
+    if k == 0: return [[[] for _ in partition]]
+    tableaux = []
+    for r in range(len(partition)):  # the largest entry k-1 sits at the end of a row that is a corner of λ
+        if partition[r] and (r + 1 == len(partition) or partition[r + 1] < partition[r]):
+            smaller = tuple(part - (i == r) for i, part in enumerate(partition))
+            for T in standard_tableaux(smaller):
+                T[r] = T[r] + [k - 1]
+                tableaux.append(T)
+    return tableaux
+
+
+def row_tableau(partition):
+    """ The tableau of shape λ filled with 0,..,k-1 row by row."""
+    return [list(range(sum(partition[:r]), sum(partition[:r + 1]))) for r in range(len(partition))]
+
+
+@cache(maxsize=None)
+def column_group(partition):
+    """ The permutations of the column stabilizer of the row tableau of shape λ."""
+    T0 = row_tableau(partition)
+    columns = [[row[c] for row in T0 if len(row) > c] for c in range(partition[0])]
+    group = []
+    for images in itertools.product(*[itertools.permutations(column) for column in columns]):
+        sigma = list(range(sum(partition)))
+        for column, image in zip(columns, images):
+            for i, j in zip(column, image): sigma[i] = j
+        group.append(tuple(sigma))
+    return group
+
+
+def tableau_axis_permutations(partition):
+    """ Permutations (as np.transpose axes) of the tensor factors that carry the row tableau to each of the
+        standard tableaux of shape λ. Applied to the column antisymmetric vectors of the λ component
+        they span all f_λ copies of the Specht module."""
+    T0 = row_tableau(partition)
+    perms = []
+    for T in standard_tableaux(partition):
+        sigma = np.zeros(sum(partition), dtype=int)
+        for row0, row in zip(T0, T): sigma[row0] = row
+        perms.append(tuple(np.argsort(sigma)))
+    return perms
+
+
+@cache(maxsize=None)
+def permutation_module_bases(content):
+    """ Orthonormal bases for the isotypic components of the permutation module of Sₖ spanned by
+        the distinct rearrangements (words) of content, ordered lexicographically. The components
+        are the images of the central idempotents P_λ = (f_λ/k!) Σ_σ χ_λ(σ)σ, which for λ=(k) and
+        λ=(1,..,1) are the symmetrizer and antisymmetrizer. Within each component only the vectors
+        that are antisymmetric under the column group of the row tableau are kept (the image of
+        the column part of the Young symmetrizer), which is one of the f_λ isomorphic copies.
+        Returns {λ: U_λ (m,r_λ)} for all λ ⊢ k, with r_λ=0 for the components that do not occur."""
+    k = len(content)
+    words = np.array(sorted(set(itertools.permutations(content))))
+    m = len(words)
+    radix = k ** np.arange(k)[::-1]
+    codes = words @ radix
+    action = lambda sigma: np.searchsorted(codes, words[:, sigma] @ radix)  # sigma as a permutation of the words
+    class_sums = defaultdict(lambda: np.zeros((m, m)))
+    for sigma in itertools.permutations(range(k)):
+        class_sums[cycle_type(sigma)][np.arange(m), action(sigma)] += 1
+    sign = lambda sigma: (-1) ** (k - len(cycle_type(sigma)))
+    bases = {}
+    for la in partitions(k):
+        P = sum(sk_character(la, ct) * S for ct, S in class_sums.items())
+        eigs, U = np.linalg.eigh(P * sk_character(la, (1,) * k) / math.factorial(k))
+        U = U[:, eigs > .5]
+        antisymmetrizer, columns = np.zeros((m, m)), column_group(la)
+        for tau in columns:
+            antisymmetrizer[np.arange(m), action(tau)] += sign(tau) / len(columns)
+        eigs, V = np.linalg.eigh(U.T @ antisymmetrizer @ U)
+        bases[la] = U @ V[:, eigs > .5]
+    return bases
+
+
+@cache(maxsize=None)
+def tensor_power_components(n, k):
+    """ Decomposes the tensor power (ℝⁿ)^⊗k into the isotypic components of Sₖ permuting the
+        tensor factors (symmetric, antisymmetric and mixed symmetry). As Sₖ commutes with the
+        action of any group on the factors, so do the projections onto the components, and
+        each λ component is f_λ copies of the (column antisymmetric) subspace W_λ that are
+        obtained from W_λ by permuting the tensor factors. Each Sₖ orbit of the multi-indices
+        is a permutation module determined by its content (the pattern of repeated indices),
+        so the basis of W_λ is block diagonal over the orbits (up to the ordering of the entries),
+        with the same small dense block for all orbits of the same content. B_λ is stored that way
+        (LazyOrbitBasis), with memory O(n^k) for the entries instead of O(n^k d_λ/f_λ).
+        Returns {λ: (B_λ,axis_perms)} with the orthonormal bases B_λ (n^k,d_λ/f_λ) of W_λ
+        and the f_λ permutations of the tensor factors that map W_λ to its copies.
+        Cached, as the decomposition depends only on n and k and not on the group or representation."""
+    ids = np.indices((n,) * k).reshape(k, -1).T  # multi-index of each entry of the tensor
+    sorted_ids = np.sort(ids, axis=1)
+    distinct = np.concatenate([np.ones((len(ids), 1), dtype=bool), sorted_ids[:, 1:] != sorted_ids[:, :-1]], axis=1)
+    # Relabel the indices by their rank among the distinct indices, entries of an orbit are the rearrangements
+    words = ((sorted_ids[:, None, :] < ids[:, :, None]) & distinct[:, None, :]).sum(-1)
+    contents = np.sort(words, axis=1)
+    orbits = sorted_ids @ n ** np.arange(k)[::-1]
+    radix = k ** np.arange(k)[::-1]
+    blocks = defaultdict(list)
+    for content in np.unique(contents, axis=0):
+        in_content = np.where((contents == content).all(-1))[0]
+        bases = permutation_module_bases(tuple(content))
+        # Sorting by orbit and then by word gives a (#orbits,m) array of the entries with the words as columns
+        entries = in_content[np.lexsort((words[in_content] @ radix, orbits[in_content]))]
+        entries = entries.reshape(-1, len(next(iter(bases.values()))))
+        for la, U in bases.items():
+            if U.shape[-1]: blocks[la].append((entries, U.astype(np.float32)))
+    # each orbit gets its own r_λ columns with values U[word]
+    return {la: (LazyOrbitBasis(entry_blocks, n ** k), tableau_axis_permutations(la))
+            for la, entry_blocks in blocks.items() if entry_blocks}
+
+
+@cache(maxsize=None)
+def power_embedding(n, k, antisymmetric=False):
+    """ Orthonormal embedding B (n^k,m) of the symmetric power Symᵏ(ℝⁿ), or of the exterior power
+        ∧ᵏ(ℝⁿ) if antisymmetric, into the tensor power (ℝⁿ)^⊗k. Coordinate j of the power is the
+        normalized (anti)symmetrization of the j-th sorted multi-index in lexicographic order, so
+        B has a single nonzero per row. Returns (cols,weights) with B[i,cols[i]] = weights[i]."""
+    ids = np.indices((n,) * k).reshape(k, -1).T
+    sorted_ids = np.sort(ids, axis=1)
+    subsets = itertools.combinations if antisymmetric else itertools.combinations_with_replacement
+    radix = n ** np.arange(k)[::-1]
+    codes = np.array(list(subsets(range(n), k)), dtype=int).reshape(-1, k) @ radix
+    cols = np.minimum(np.searchsorted(codes, sorted_ids @ radix), max(len(codes) - 1, 0))
+    if antisymmetric:
+        distinct = (sorted_ids[:, 1:] != sorted_ids[:, :-1]).all(-1)
+        inversions = sum(ids[:, i] > ids[:, j] for i in range(k) for j in range(i + 1, k))
+        weights = np.where(distinct, (-1.) ** inversions / np.sqrt(math.factorial(k)), 0)
+    else:  # the orbit of a multi-index with multiplicities c₁,c₂,.. has k!/∏cᵢ! elements
+        repeats = ((sorted_ids[:, :, None] == sorted_ids[:, None, :]) & np.tri(k, k, -1, dtype=bool)).sum(-1)
+        weights = np.sqrt(np.prod(repeats + 1, axis=-1) / math.factorial(k))
+    return cols, weights.astype(np.float32)
@@ -5,6 +5,7 @@ from emlp.reps import *
 from emlp.groups import *
 from emlp.nn import uniform_rep
 import pytest#import unittest
+import jax
 from jax import vmap
 import jax.numpy as jnp
 import logging
@@ -49,6 +50,39 @@ def parametrize(cases,ids=None):
         theids = [strip_parens(str(case)) for case in cases] if ids is None else ids
         return pytest.mark.parametrize(argnames,cases,ids=theids)(test_fn)
     return decorator
+
+def backend_cases(backends,cases):
+    """ The test cases crossed with the nn backends, as (backend,*case) """
+    return [(backend,*case) for backend in backends for case in cases]
+
+def backend_layer(backend,name,repin,repout):
+    """ Builds the layer emlp.nn.<backend>.<name>(repin,repout) (for pytorch the EquivLinear
+        variant of the name) and returns it along with a function applying it to numpy arrays """
+    if backend=='objax':
+        import emlp.nn.objax as nn_objax
+        layer = getattr(nn_objax,name)(repin,repout)
+        return layer,lambda x: np.asarray(layer(jnp.asarray(x,dtype=jnp.float32)))
+    if backend=='pytorch':
+        torch = pytest.importorskip('torch')
+        import emlp.nn.pytorch as nn_torch
+        layer = getattr(nn_torch,name.replace('Linear','EquivLinear'))(repin,repout)
+        def apply(x):
+            with torch.no_grad():
+                return layer(torch.tensor(np.asarray(x),dtype=torch.float32)).numpy()
+        return layer,apply
+    if backend=='flax':
+        pytest.importorskip('flax')
+        import emlp.nn.flax as nn_flax
+        layer = getattr(nn_flax,name)(repin,repout)
+        params = layer.init(jax.random.PRNGKey(0),jnp.zeros((1,repin.size())))
+        return layer,lambda x: np.asarray(layer.apply(params,jnp.asarray(x,dtype=jnp.float32)))
+    if backend=='haiku':
+        hk = pytest.importorskip('haiku')
+        import emlp.nn.haiku as nn_haiku
+        layer = hk.without_apply_rng(hk.transform(getattr(nn_haiku,name)(repin,repout)))
+        params = layer.init(jax.random.PRNGKey(0),jnp.zeros((1,repin.size())))
+        return layer,lambda x: np.asarray(layer.apply(params,jnp.asarray(x,dtype=jnp.float32)))
+    raise ValueError(f"Unknown backend {backend}")
 # def expand_cases(cls,argseq):
 #     def class_decorator(testcase):
 #         for args in argseq:
@@ -132,6 +166,25 @@ def test_high_rank_representations(G):
             #     print(f"Failed with G={G} and T({p,q})")
             #     raise e
 
+@parametrize([SO(3),O(4),SU(2),SL(3),S(4),SO13p(),Z(5)])
+def test_symmetric_powers(G):
+    N=5
+    gs = G.samples(N)
+    for k in [2,3]:
+        for power in [Sym(V,k)(G),Wedge(V,k)(G)]:
+            if not power.size(): continue
+            B = power.tensor_embedding()@np.eye(power.size())
+            # the compact coordinates are an invariant subspace of the full tensors
+            err = jnp.abs(vmap(T(k)(G).rho_dense)(gs)@B-B@vmap(power.rho_dense)(gs)).max()
+            assert err<1e-4,f"{power} does not match the restriction of T{k} err {err:.3e} with G={G}"
+    rep = (Sym(V,2)+Wedge(V,2))*Sym(V.T,2)+V
+    rep = rep(G)
+    Q = rep.equivariant_basis()
+    v = Q@np.random.rand(Q.shape[-1])
+    gv = (vmap(rep.rho_dense)(gs)*v).sum(-1)
+    err = vmap(scale_adjusted_rel_error)(gv,v+jnp.zeros_like(gv),gs).mean()
+    assert err<1e-4,f"Symmetric vector fails err {err:.3e} with G={G}"
+
 @parametrize([
     (SO(3),T(1)+2*T(0),T(1)+T(2)+2*T(0)+T(1)),
     (SO(3),5*T(0)+5*T(1),3*T(0)+T(2)+2*T(1)),
@@ -190,6 +243,183 @@ def test_bilinear_layer(G,repin,repout):
     equiv_err = rel_error(Wgxgx,gWxx)
     assert equiv_err<1e-4,f"Bilinear Equivariance fails err {equiv_err:.3e} with G={G}"
 
+@parametrize(backend_cases(['objax','pytorch','flax','haiku'],
+             [(SO(3),5*T(0)+5*T(1),3*T(0)+T(2)+2*T(1)),
+              (S(4),T(1)+T(0),2*T(1)+T(2)),
+              (SO13p(),4*T(1,0)+T(0,1),2*T(0)+T(1,0)+T(1,1))]))
+def test_basis_layer(backend,G,repin,repout):
+    N=5
+    repin = repin(G)
+    repout = repout(G)
+    layer,apply = backend_layer(backend,'BasisLinear',repin,repout)
+    x = np.random.rand(N,repin.size())
+    gs = G.samples(N)
+    ring = vmap(repin.rho_dense)(gs)
+    routg = vmap(repout.rho_dense)(gs)
+    gx = (ring@x[...,None])[...,0]
+    gWx = (routg@apply(x)[...,None])[...,0]
+    assert apply(x).shape==(N,repout.size())
+    equiv_err = rel_error(apply(gx),gWx)
+    assert equiv_err<1e-4,f"Basis layer equivariance fails err {equiv_err:.3e} with G={G}"
+    if backend in ('objax','pytorch'):
+        w = layer.w.value if backend=='objax' else layer.weight
+        assert w.shape[0]==(repin>>repout).equivariant_basis().shape[-1]<repin.size()*repout.size()
+
+@parametrize(backend_cases(['objax','pytorch'],
+             [(SO(3),T(1)+2*T(0),T(1)+T(2)+2*T(0)+T(1)),
+              (O(3),5*T(0)+5*T(1),3*T(0)+T(2)+2*T(1)),
+              (SO(4),T(1)+2*T(2),T(0)+T(3)),
+              (SO13p(),T(2)+4*T(1,0)+T(0,1),10*T(0)+3*T(1,0)+3*T(0,1)+T(0,2)+T(2,0)+T(1,1)),
+              (O13(),T(1,1)+T(1,0),T(0)+T(2,0)+T(0,1)),
+              (SO11p(),T(1,0)+T(0,1),T(1,1)+T(1,0))]))
+def test_contraction_layer(backend,G,repin,repout):
+    N=5
+    repin = repin(G)
+    repout = repout(G)
+    layer,apply = backend_layer(backend,'ContractionLinear',repin,repout)
+    x = np.random.rand(N,repin.size())
+    gs = G.samples(N)
+    ring = vmap(repin.rho_dense)(gs)
+    routg = vmap(repout.rho_dense)(gs)
+    gx = (ring@x[...,None])[...,0]
+    gWx = (routg@apply(x)[...,None])[...,0]
+    equiv_err = rel_error(apply(gx),gWx)
+    assert equiv_err<1e-4,f"Contraction layer equivariance fails err {equiv_err:.3e} with G={G}"
+    if backend!='objax': return
+    # The contraction patterns span all of the equivariant maps
+    contractions = layer.contractions
+    W = lambda w: contractions(jnp.eye(repin.size()),w,jnp.zeros(contractions.bias_size),layer.constants,
+                               jnp.einsum,lambda ys: jnp.concatenate(ys,-1),jnp.zeros)
+    maps = jax.jacfwd(W)(jnp.zeros(contractions.weight_size)).reshape(-1,contractions.weight_size)
+    rank = np.linalg.matrix_rank(np.asarray(maps),tol=1e-4)
+    assert rank==(repin>>repout).equivariant_basis().shape[-1],f"Contractions span {rank} maps with G={G}"
+
+@parametrize(backend_cases(['objax','pytorch'],
+             [(Z(6),2*V+T(0),V+2*T(0)),
+              (ZksZnxZn(4,3),V+T(0),2*V),
+              (ZksZnxZn(2,4),2*V,V+T(0))]))
+def test_convolution_layer(backend,G,repin,repout):
+    N=5
+    repin = repin(G)
+    repout = repout(G)
+    layer,apply = backend_layer(backend,'ConvolutionLinear',repin,repout)
+    x = np.random.rand(N,repin.size())
+    gs = G.samples(N)
+    ring = vmap(repin.rho_dense)(gs)
+    routg = vmap(repout.rho_dense)(gs)
+    gx = (ring@x[...,None])[...,0]
+    gWx = (routg@apply(x)[...,None])[...,0]
+    equiv_err = rel_error(apply(gx),gWx)
+    assert equiv_err<1e-4,f"Convolution layer equivariance fails err {equiv_err:.3e} with G={G}"
+    if backend!='objax': return
+    # The group convolutions are exactly the equivariant maps
+    convolutions = layer.convolutions
+    fft = lambda a: jnp.fft.fftn(a,axes=layer.axes)
+    ifft = lambda a: jnp.fft.ifftn(a,axes=layer.axes)
+    W = lambda w: convolutions(jnp.eye(repin.size()),w,jnp.zeros(convolutions.bias_size),layer.constants,
+                               jnp.einsum,fft,ifft,lambda ys: jnp.concatenate(ys,-1),jnp.zeros)
+    maps = jax.jacfwd(W)(jnp.zeros(convolutions.weight_size)).reshape(-1,convolutions.weight_size)
+    rank = np.linalg.matrix_rank(np.asarray(maps),tol=1e-4)
+    assert rank==convolutions.weight_size==(repin>>repout).equivariant_basis().shape[-1]
+
+@parametrize(backend_cases(['objax','pytorch'],
+             [(S(4),V+T(2)+T(0),2*V+T(0)),
+              (RubiksCube(),V+T(0),2*V),
+              (ZksZnxZn(2,3),V,V+T(2))]))
+def test_orbit_layer(backend,G,repin,repout):
+    N=5
+    repin = repin(G)
+    repout = repout(G)
+    layer,apply = backend_layer(backend,'OrbitLinear',repin,repout)
+    x = np.random.rand(N,repin.size())
+    gs = G.samples(N)
+    ring = vmap(repin.rho_dense)(gs)
+    routg = vmap(repout.rho_dense)(gs)
+    gx = (ring@x[...,None])[...,0]
+    gWx = (routg@apply(x)[...,None])[...,0]
+    equiv_err = rel_error(apply(gx),gWx)
+    assert equiv_err<1e-4,f"Orbit layer equivariance fails err {equiv_err:.3e} with G={G}"
+    w,b = (layer.w.value,layer.b.value) if backend=='objax' else (layer.weight,layer.bias)
+    assert w.shape[0]==(repin>>repout).invariant_dimension()
+    assert b.shape[0]==repout.invariant_dimension()
+
+@parametrize([(SO(3),2*T(1)+T(0),T(1)+T(2)+T(0)),(S(4),T(1)+T(0),2*T(1))])
+def test_projected_optimizer(G,repin,repout):
+    import torch
+    from emlp.nn.pytorch import EquivLinear, ProjectedOptimizer
+    repin = repin(G)
+    repout = repout(G)
+    layer = EquivLinear(repin,repout)
+    optimizer = ProjectedOptimizer(layer,torch.optim.Adam(layer.parameters(),lr=1e-2),check_every=1)
+    x = torch.randn(8,repin.size())
+    for _ in range(3):
+        optimizer.zero_grad()
+        ((layer(x)-1)**2).mean().backward()
+        optimizer.step()
+    assert optimizer.drift()<1e-5
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer,step_size=1,gamma=.5)
+    optimizer.step()
+    scheduler.step()
+    assert optimizer.optimizer.param_groups[0]['lr']==5e-3
+    optimizer.load_state_dict(optimizer.state_dict())
+    g = G.sample()
+    ring = torch.tensor(np.asarray(repin.rho_dense(g)),dtype=torch.float32)
+    routg = torch.tensor(np.asarray(repout.rho_dense(g)),dtype=torch.float32)
+    with torch.no_grad():
+        equiv_err = rel_error(layer(x@ring.T).numpy(),(layer(x)@routg.T).numpy())
+    assert equiv_err<1e-4,f"Projected optimizer equivariance fails err {equiv_err:.3e} with G={G}"
+
+@parametrize([(SO(3),2*T(1)+T(0),T(1)+T(2)+T(0)),(S(4),T(1)+T(0),2*T(1))])
+def test_objax_projected_optimizer(G,repin,repout):
+    import objax
+    from emlp.nn.objax import Linear, ProjectedOptimizer
+    repin = repin(G)
+    repout = repout(G)
+    layer = Linear(repin,repout)
+    optimizer = ProjectedOptimizer(layer,objax.optimizer.SGD(layer.vars()),check_every=1)
+    x = jnp.asarray(np.random.randn(8,repin.size()),dtype=jnp.float32)
+    grad_and_val = objax.GradValues(lambda x: ((layer(x)-1)**2).mean(),layer.vars())
+    def train_op(x):
+        grads,loss = grad_and_val(x)
+        optimizer(1e-1,grads)
+        return loss
+    train_op = objax.Jit(train_op,grad_and_val.vars()+optimizer.vars())
+    for step in range(3):
+        w = layer.w.value
+        train_op(x)
+        assert not np.allclose(layer.w.value,w),"The optimizer did not update the weights"
+        w,b = layer.w.value.reshape(-1),layer.b.value
+        assert rel_error(layer.Pw@w,w)<1e-5 and rel_error(layer.Pb@b,b)<1e-5,f"Weights left the equivariant subspace at step {step}"
+    assert int(optimizer.steps.value)==3
+    g = G.sample()
+    equiv_err = rel_error(layer(x@repin.rho_dense(g).T),layer(x)@repout.rho_dense(g).T)
+    assert equiv_err<1e-4,f"Objax projected optimizer equivariance fails err {equiv_err:.3e} with G={G}"
+
+def test_lazy_torch_conversion():
+    import torch
+    from emlp.reps.linear_operator_base import Lazy
+    A = np.random.randn(3,4).astype(np.float32)
+    for M in [A,jnp.asarray(A)]:
+        assert torch.allclose(Lazy(M).get_A_torch('cpu'),torch.from_numpy(A))
+
+def test_projection_cache():
+    import torch
+    from emlp.nn.pytorch import EquivLinear
+    G = SO(3)
+    layer = EquivLinear((2*V+V**0)(G),(V+V**2)(G))
+    x = torch.randn(8,layer.nin)
+    with torch.no_grad():
+        weight, _ = layer.projected_parameters()
+        assert layer.projected_parameters()[0] is weight, "Projection recomputed for unchanged weights"
+    with torch.no_grad():
+        layer.weight.add_(1.)
+        assert layer.projected_parameters()[0] is not weight, "Projection cache not invalidated by the update"
+        y = layer(x)
+        layer.freeze()
+        assert rel_error(layer(x).numpy(),y.numpy())<1e-5 and not layer.weight.requires_grad
+    layer.unfreeze()
+    assert rel_error(layer(x).detach().numpy(),y.numpy())<1e-5 and layer.weight.requires_grad
+
 @parametrize(test_groups)
 def test_large_representations(G):
     N=5
@@ -0,0 +1,241 @@
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import jax.numpy as jnp
+from emlp.reps import T, V, parallel_options
+from emlp.reps.representation import Rep
+from emlp.reps.representation import orbit_basis, orthogonal_complement, krylov_constraint_solve, gram_constraint_solve
+from emlp.reps.representation import krylov_constraint_solve_upto_r, lobpcg_constraint_solve_upto_r
+from emlp.groups import *
+from equivariance_tests import parametrize
+
+
+def same_span(Q1, Q2, tol=1e-4):
+    Q1, Q2 = np.asarray(Q1), np.asarray(Q2)
+    if Q1.shape[-1] != Q2.shape[-1]: return False
+    if not Q1.shape[-1]: return True
+    return np.abs(Q1 @ (Q1.T.conj() @ Q2) - Q2).max() < tol
+
+
+def dense_basis(rep):
+    return orthogonal_complement(rep.constraint_matrix().to_dense())
+
+
+@parametrize([S(4), Cube(), Z(6), ZksZnxZn(2, 2), Trivial(3)])
+def test_orbit_basis(G):
+    for rep in [T(1), T(2), T(1, 1), T(3)]:
+        rep = rep(G)
+        Q = orbit_basis(rep)
+        assert np.abs(Q.T @ Q - np.eye(Q.shape[-1])).max() < 1e-5, "Orbit basis is not orthonormal"
+        assert same_span(Q, dense_basis(rep)), f"Orbit basis does not match dense solution for {rep} of {G}"
+
+
+@parametrize([SO(3), O(3), SO13p(), SU(2)])
+def test_lobpcg_solver(G):
+    for rep in [T(2), T(3)]:
+        rep = rep(G)
+        residuals = []
+        Q = krylov_constraint_solve(rep.constraint_matrix(), method='lobpcg',
+                                    callback=lambda i, res: residuals.append(res))
+        assert residuals, "Residual callback was not called"
+        assert same_span(Q, dense_basis(rep)), f"LOBPCG basis does not match dense solution for {rep} of {G}"
+
+
+@pytest.mark.parametrize("solve_upto_r", [krylov_constraint_solve_upto_r, lobpcg_constraint_solve_upto_r])
+def test_warm_started_solve(solve_upto_r):
+    rep = T(4)(SO(3))
+    C = rep.constraint_matrix()
+    Q_dense = dense_basis(rep)
+    Q0 = np.asarray(Q_dense[:, :1])
+    Q = solve_upto_r(C, 5, Q0=Q0)
+    np.testing.assert_allclose(np.asarray(Q[:, :1]), Q0, atol=1e-6, err_msg="Converged columns were not kept")
+    assert same_span(Q, Q_dense), "Warm started solution does not match dense solution"
+
+
+@parametrize([SO(3), S(6), Sp(2), SO13(), U(2)])
+def test_gram_solver(G):
+    for rep in [T(2), T(3), V * V.T]:
+        rep = rep(G)
+        Q = gram_constraint_solve(rep.constraint_matrix())
+        assert same_span(Q, dense_basis(rep)), f"Gram solution does not match dense solution for {rep} of {G}"
+
+
+def test_parallel_sum_solve():
+    rep = (T(0) + T(1) + 2 * T(2) + T(3) + T(1, 1) + T(2, 1))(SO(3))
+    x = np.random.randn(rep.size())
+    Rep.solcache.clear()
+    P = rep.equivariant_projector() @ x
+    Rep.solcache.clear()
+    with ThreadPoolExecutor(4) as executor:
+        parallel_options['threads'] = executor
+        try:
+            P_parallel = rep.equivariant_projector() @ x
+        finally:
+            parallel_options['threads'] = None
+    assert all(leaf in Rep.solcache for leaf in rep.basis_components())
+    np.testing.assert_allclose(P_parallel, P, atol=1e-5)
+
+
+def test_solve_plan():
+    from emlp.reps import SolvePlan
+    from emlp.nn import gated, uniform_rep, Linear
+    G = SO(3)
+    reps = [V(G), uniform_rep(100, G), uniform_rep(100, G)]
+    layers = [(rin, gated(rout)) for rin, rout in zip(reps, reps[1:])] + [(reps[-1], T(2)(G))]
+    plan = SolvePlan(layers)
+    costs = [plan.components[rep] for rep in plan.schedule]
+    assert costs == sorted(costs, reverse=True), "Solves are not scheduled largest first"
+    plan.execute()
+    assert not plan.pending()
+    n_cached = len(Rep.solcache)
+    for rin, rout in layers: Linear(rin, rout)
+    assert len(Rep.solcache) == n_cached, "Building the layers required solves that were not planned"
+
+
+@pytest.mark.parametrize("method", ['sgd', 'sgd_device'])
+def test_krylov_solver(method):
+    for rep in [T(3)(SO(3)), T(2)(SO13p())]:
+        Q = krylov_constraint_solve(rep.constraint_matrix(), method=method)
+        assert same_span(Q, dense_basis(rep), tol=1e-3), f"{method} basis does not match dense solution for {rep}"
+
+
+@parametrize([T(4)(SO(3)), T(4)(O(3)), T(3)(O(2)), T(4)(SO(4)), T(4)(O(5)), T(2, 2)(U(2)), T(3)(SU(3)),
+              T(3)(D(3)), T(2)(Cube()), T(3)(S(4)), V(SO(2)) * V(S(3)), T(2)(SO(3)) + T(1, 1)(S(3))])
+def test_invariant_dimension(rep):
+    assert rep.invariant_dimension() == rep.equivariant_basis().shape[-1]
+
+
+@parametrize([T(3)(S(4)), V(Z(4)) * V(S(3)), T(2)(S(3)) + V(S(3))])
+def test_closed_form_invariant_dimension(rep):
+    assert rep.invariant_dimension(closed_form=True) == rep.invariant_dimension() == rep.equivariant_basis().shape[-1]
+
+
+@parametrize([T(2)(D(3)), T(2)(SO(3)), T(2)(SO(3)) + T(1, 1)(S(3)), V(SO(2)) * V(S(3))])
+def test_character_invariant_dimension(rep):
+    assert rep.invariant_dimension(closed_form=True) is None
+    assert rep.invariant_dimension() == rep.equivariant_basis().shape[-1]
+
+
+def test_krylov_solver_known_rank():
+    rep = T(4)(SO(3))
+    Q = krylov_constraint_solve(rep.constraint_matrix(), method='lobpcg', rank=rep.invariant_dimension())
+    assert same_span(Q, dense_basis(rep), tol=1e-3)
+
+
+@parametrize([S(5), D(4), ZksZnxZn(2, 3), SO(3), O(3), GL(3), SU(3), SO13p()])
+def test_minimal_generators(G):
+    discrete_generators, lie_algebra = G.minimal_generators()
+    assert len(discrete_generators) <= len(G.discrete_generators) and len(lie_algebra) <= len(G.lie_algebra)
+    assert len(discrete_generators) + len(lie_algebra) < G.num_constraints() or G in [D(4), ZksZnxZn(2, 3)]
+    rep = T(2)(G) if G.d > 3 else T(3)(G)
+    C = rep.constraint_matrix((discrete_generators, lie_algebra))
+    assert same_span(gram_constraint_solve(C), dense_basis(rep))
+
+
+def test_minimal_generators_without_enumeration():
+    G = D(4)
+
+    def elements(max_order=10000):
+        raise NotImplementedError("Group has more than 10000 elements")
+
+    G.elements = elements
+    discrete_generators, _ = G.minimal_generators()
+    assert discrete_generators is G.discrete_generators
+
+
+def test_schreier_sims():
+    from emlp.groups import schreier_sims, stabilizer_order, permutation_indices
+    for G, order in [(S(5), 120), (Cube(), 24), (ZksZnxZn(4, 3), 36)]:
+        perms = [permutation_indices(h) for h in G.discrete_generators]
+        assert stabilizer_order(schreier_sims(perms, G.d)) == order
+
+
+def test_solve_with_minimal_generators():
+    from emlp.reps.representation import solve_equivariant_basis, solver_options
+    rep = T(2, 1)(GL(3))
+    Q = solve_equivariant_basis(rep, dict(solver_options, minimal_generators=True, verify_generators=True))
+    assert same_span(Q, dense_basis(rep))
+
+
+@parametrize([T(4)(SO(3)), T(2)(SO13p()), T(2, 2)(U(2)), T(3)(O(3))])
+def test_sequential_solver(rep):
+    from emlp.reps.representation import solve_equivariant_basis, solver_options
+    Q = solve_equivariant_basis(rep, dict(solver_options, sequential=True))
+    assert same_span(Q, dense_basis(rep))
+
+
+def test_subgroup_basis_reuse(caplog):
+    import logging
+    Rep.solcache.clear()
+    for H, G in [(SO(3), O(3)), (C(4), D(4)), (SO13p(), O13()), (O13(), Lorentz())]:
+        rep = T(2, 2)
+        rep(H).equivariant_basis()
+        with caplog.at_level(logging.INFO):
+            Q = rep(G).equivariant_basis()
+        assert f"cached basis of subgroup {H}" in caplog.text
+        assert same_span(Q, dense_basis(rep(G)))
+
+
+def test_subgroup_basis_reuse_skips_failing_subgroups(monkeypatch, caplog):
+    import logging
+    import emlp.reps.representation as representation
+    Rep.solcache.clear()
+    rep, G = T(2, 2), O(3)
+    rep(SO(3)).equivariant_basis()
+    G.subgroups = lambda: [(C(4), ((), ())), (SO(3), ((G.discrete_generators[-1],), ()))]
+    cached_basis = representation.cached_basis
+
+    def failing_cached_basis(rep):
+        if rep.G == C(4): raise NotImplementedError
+        return cached_basis(rep)
+
+    monkeypatch.setattr(representation, 'cached_basis', failing_cached_basis)
+    with caplog.at_level(logging.INFO):
+        Q = representation.solve_equivariant_basis(rep(G).canonicalize()[0])
+    assert f"cached basis of subgroup {SO(3)}" in caplog.text
+    assert same_span(Q, dense_basis(rep(G)))
+
+
+@parametrize([T(2)(SO(3) * S(3)), T(2, 1)(SO13p() * SO(2)), T(2)((SO(2) * S(2)) * SO(3)), T(4)(SO(3) * SO(3))])
+def test_product_group_factorization(rep):
+    reps, kron_perm = rep.factorize()
+    assert sorted(kron_perm) == list(range(rep.size()))
+    Q = rep.equivariant_basis()
+    if rep.size() < 1000: assert Q.shape[-1] == gram_constraint_solve(rep.constraint_matrix()).shape[-1]
+    v = Q @ np.random.randn(Q.shape[-1])
+    gv = rep.rho_dense(rep.G.sample()) @ v
+    assert np.abs(gv - v).max() <= 1e-4 * np.abs(v).max(), "Factorized basis is not equivariant"
+
+
+@parametrize([T(2)(SO2eR3()), T(3)(O2eR3()), T(2)(DkeR3(4)), T(1, 1)(Embed(SO13p(), 5, slice(1, 5)))])
+def test_embedded_group_restriction(rep):
+    rep_G, embed_perm = rep.restrict_embedding()
+    assert rep_G.size() == rep.size() and sorted(embed_perm) == list(range(rep.size()))
+    assert set(rep.basis_components()) == set(rep_G.basis_components())
+    Q = rep.equivariant_basis()
+    assert same_span(Q @ np.eye(Q.shape[-1]), dense_basis(rep))
+    P = rep.equivariant_projector()
+    assert np.abs(P @ np.eye(rep.size()) - dense_basis(rep) @ dense_basis(rep).T).max() < 1e-4
+
+
+@parametrize([(3, 3), (4, 4), (2, 5)])
+def test_tensor_power_components(nk):
+    from emlp.reps.symmetric_group import tensor_power_components
+    n, k = nk
+    ids = np.arange(n ** k).reshape((n,) * k)
+    components = tensor_power_components(n, k).values()
+    for B, _ in components:  # the lazy blocks are orthonormal and agree with their transposes
+        B_dense = np.asarray(B.to_dense())
+        assert np.allclose(B_dense.T @ B_dense, np.eye(B.shape[-1]), atol=1e-5)
+        assert np.allclose(np.asarray(B.T @ np.eye(n ** k)), B_dense.T, atol=1e-6)
+    copies = [np.asarray(B.to_dense())[ids.transpose(perm).reshape(-1)] for B, perms in components for perm in perms]
+    Q = np.concatenate(copies, axis=-1)
+    assert Q.shape == (n ** k, n ** k) and np.linalg.matrix_rank(Q, 1e-4) == n ** k, \
+        "Isotypic components do not span the tensor power"
+
+
+@parametrize([T(4)(SO(3)), T(2, 2)(U(2)), T(3)(O(3)), T(2, 1)(SL(2)), T(3)(SO13p())])
+def test_isotypic_solver(rep):
+    from emlp.reps.representation import solve_equivariant_basis, solver_options
+    Q = solve_equivariant_basis(rep, dict(solver_options, isotypic=True))
+    assert same_span(Q, dense_basis(rep))
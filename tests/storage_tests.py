@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from emlp.reps import T, V, BasisStore, get_basis_store, set_basis_store
+from emlp.reps.representation import Rep
+from emlp.groups import SO, O
+
+
+@pytest.fixture
+def store(tmp_path):
+    """ Use a fresh basis store and an empty in memory cache for the test."""
+    old_store = get_basis_store()
+    new_store = set_basis_store(str(tmp_path))
+    Rep.solcache.clear()
+    yield new_store
+    set_basis_store(old_store)
+    Rep.solcache.clear()
+
+
+def test_basis_store_roundtrip(store):
+    rep = T(2)(SO(3))
+    Q = rep.equivariant_basis()
+    assert rep in store
+    Q_loaded = store.load(rep)
+    assert isinstance(Q_loaded, np.memmap)
+    np.testing.assert_allclose(Q_loaded, np.asarray(Q))
+    assert len(store.manifest()) == 1
+
+
+def test_basis_store_distinguishes_groups(store):
+    assert store.key(T(2)(SO(3))) != store.key(T(2)(O(3)))
+    assert store.key(T(2)(SO(3))) != store.key(T(3)(SO(3)))
+    assert store.key(T(2)(SO(3))) == store.key((V * V)(SO(3)))
+
+
+def test_basis_store_reload(store):
+    rep = T(3)(SO(3))
+    Q = np.asarray(rep.equivariant_basis())
+    Rep.solcache.clear()  # Fresh process: only the disk store remains
+    np.testing.assert_allclose(np.asarray(rep.equivariant_basis()), Q)
+    store.clear()
+    assert rep not in store
+
+
+def test_basis_cache_budget(store):
+    from emlp.reps import BasisCache
+    cache = BasisCache(max_bytes=None)
+    reps = [T(k)(SO(3)) for k in range(1, 4)]
+    for rep in reps:
+        cache[rep] = np.ones((rep.size(), 2), dtype=np.float32)
+    assert cache.nbytes == sum(8 * rep.size() for rep in reps)
+    cache.get(reps[0])  # reps[1] becomes the least recently used
+    cache.max_bytes = cache.nbytes - 1
+    assert reps[1] not in cache and reps[0] in cache and reps[2] in cache
+    assert cache.evictions == 1 and cache.nbytes <= cache.max_bytes
+    assert reps[1] in store, "Evicted basis was not spilled to the store"
+    assert cache.get(reps[1]) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_basis_cache_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    from emlp.reps import BasisCache
+    cache = BasisCache(max_bytes=3 * 64, spill=False)
+    keys = list(range(8))
+
+    def work(i):
+        for j in range(2000):
+            key = keys[(i + j) % len(keys)]
+            if j % 3: cache.get(key)
+            else: cache[key] = np.ones(16, dtype=np.float32)
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(work, range(4)))
+    assert cache.nbytes == 64 * len(cache) <= cache.max_bytes
+
+
+def test_fingerprints_are_stable_across_processes():
+    import os, subprocess, sys
+    code = ("from emlp.reps import V, T; from emlp.groups import SO, S, Z;"
+            "rep = V(SO(3)) + V(S(3)) + T(2)(Z(3)) + V(SO(3)) * V(S(3));"
+            "print(rep.fingerprint(), list(rep.canonicalize()[1]))")
+    outputs = set()
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed, EMLP_BASIS_STORE='')
+        outputs.add(subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                                   text=True, check=True).stdout.splitlines()[-1])
+    assert len(outputs) == 1, f"Fingerprints or canonical orderings differ between processes: {outputs}"
+
+
+def test_fingerprint_ignores_field_order():
+    rep = V(SO(3)) * V(O(3))
+    other = V(SO(3)) * V(O(3))
+    other.__dict__ = dict(reversed(list(other.__dict__.items())))
+    assert rep.fingerprint() == other.fingerprint()
+    assert rep._fingerprint is not None and rep == other and hash(rep) == hash(other)
+
+
+@pytest.mark.parametrize("method", ['sgd', 'lobpcg'])
+def test_solve_checkpoint_resume(store, method):
+    from emlp.reps.representation import krylov_constraint_solve
+
+    class Preempted(Exception): pass
+
+    rep = T(3)(SO(3))
+    C = rep.constraint_matrix()
+    checkpoint = store.checkpoint(rep, interval=0)
+    save = checkpoint.save
+
+    def save_then_preempt(**state):
+        save(**state)
+        if state['step'] >= 3: raise Preempted
+
+    checkpoint.save = save_then_preempt
+    with pytest.raises(Preempted):
+        krylov_constraint_solve(C, method=method, checkpoint=checkpoint)
+    state = store.checkpoint(rep).load()
+    assert state is not None and int(state['step']) == 3
+    resumed = store.checkpoint(rep)
+    Q = np.asarray(krylov_constraint_solve(C, method=method, checkpoint=resumed))
+    assert Q.shape[-1] == 1 and np.abs(C @ Q).max() < 1e-4
+    assert resumed.load() is None, "Checkpoint was not removed after the solve finished"